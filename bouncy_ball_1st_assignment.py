@@ -15,12 +15,35 @@ user wishes. The function requires three initial conditions:
 If one of these initial conditions provided is not physical an error meassage
 will be printed.
 
+Many scenarios can be run without prompts by streaming a CSV of initial
+conditions through the batch mode:
+
+    python bouncy_ball_1st_assignment.py --batch input.csv --output out.csv
+
 Last Updated: 24/10/2020
 @author: J. Sharma UID: 10304831
 """
+# IMPORT STATEMENTS
+
+import argparse
+import itertools
+import sys
+import numpy as np
+
 # CONSTANTS
 
 ACCELERATION = 9.81  # m/s^2
+CHUNK_SIZE = 100000  # rows per chunk in batch mode
+BATCH_COLUMNS = ('initial_height', 'minimum_height', 'efficiency', 'valid',
+                 'time', 'distance', 'bounces', 'average_speed')
+BOUNCE_DTYPE = np.dtype([('bounce', np.int64), ('time', np.float64),
+                         ('apex_height', np.float64),
+                         ('impact_velocity', np.float64)])
+BLOCK_SIZE = 4096  # records per block when exporting bounce events
+SOLVER_TOLERANCE = 1e-12  # relative bracket width the inverse solver stops at
+SOLVER_MAX_ITERATIONS = 200
+TIME_TARGET_TOLERANCE = 1e-6  # relative miss allowed on a total time target
+NEAR_TIE_ULPS = 16  # bounce heights this close to the minimum are rechecked
 
 # FUNCTIONS
 
@@ -102,6 +125,445 @@ def total_bounces(initial_height, minimum_height, efficiency):
     return bounces
 
 
+def bounce_engine(initial_height, minimum_height, efficiency):
+    """
+    Calculates the total time, total distance and number of bounces above a
+    specified minimum height for many falling bouncy balls at once. Heights
+    are in meters. The inputs can be floats or numpy arrays of any shape that
+    broadcast together.
+
+    The height after k bounces is initial_height * efficiency**k, so the
+    number of bounces is found from a logarithm and the distance and time
+    from finite geometric sums, instead of looping over every bounce.
+    Scenarios that do not satisfy the boundary conditions of
+    initial_conditions_checker give nan. A ball that bounces forever
+    (efficiency = 1 or minimum_height <= 0) gives an infinite number of
+    bounces.
+
+    Args:
+        initial_height : FLOAT or numpy array
+        minimum_height : FLOAT or numpy array
+        efficiency : FLOAT or numpy array
+    Returns:
+        time: [numpy array]
+        distance: [numpy array]
+        bounces: [numpy array]
+    """
+    initial_height, minimum_height, efficiency = np.broadcast_arrays(
+        np.asarray(initial_height, dtype=float),
+        np.asarray(minimum_height, dtype=float),
+        np.asarray(efficiency, dtype=float))
+
+    valid = conditions_mask(initial_height, minimum_height, efficiency)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_efficiency = np.where(valid, np.log(efficiency), np.nan)
+
+        # Bounces are the k >= 1 with initial_height * efficiency**k above
+        # the minimum height.
+        bounce_limit = (np.log(minimum_height / initial_height) /
+                        log_efficiency)
+        bounces = np.where(initial_height > minimum_height,
+                           np.ceil(bounce_limit) - 1, 0.)
+        bounces = np.where(
+            (initial_height > minimum_height) &
+            ((minimum_height <= 0) | (efficiency == 1)), np.inf, bounces)
+        bounces = np.where(valid, np.maximum(bounces, 0.), np.nan)
+
+        # The logarithm can be off by one at the boundary, so check the
+        # heights either side of the bounce count.
+        finite = np.isfinite(bounces)
+        finite_bounces = np.where(finite, bounces, 0.)
+        bounces = np.where(
+            finite & bounce_height_above(initial_height, minimum_height,
+                                         efficiency, finite_bounces + 1),
+            bounces + 1, bounces)
+        bounces = np.where(
+            finite & (finite_bounces > 0) &
+            ~bounce_height_above(initial_height, minimum_height, efficiency,
+                                 finite_bounces), bounces - 1, bounces)
+
+        # sum_{k=1}^{n} r**k = r * (1 - r**n) / (1 - r), written with expm1
+        # to stay accurate as the efficiency approaches 1.
+        height_sum = np.where(
+            efficiency == 1, bounces,
+            efficiency * np.expm1(bounces * log_efficiency) /
+            np.expm1(log_efficiency))
+        time_sum = np.where(
+            efficiency == 1, bounces,
+            np.sqrt(efficiency) * np.expm1(bounces * log_efficiency / 2) /
+            np.expm1(log_efficiency / 2))
+        height_sum = np.where(bounces == 0, 0., height_sum)
+        time_sum = np.where(bounces == 0, 0., time_sum)
+
+        fall_time = (2 * initial_height / ACCELERATION) ** 0.5
+        time = np.where(valid, fall_time * (1 + 2 * time_sum), np.nan)
+        distance = np.where(valid, initial_height * (1 + 2 * height_sum),
+                            np.nan)
+
+    return time, distance, bounces
+
+
+def bounce_height_above(initial_height, minimum_height, efficiency, bounces):
+    """
+    Checks if the height after a number of bounces,
+    initial_height * efficiency**bounces, is above the minimum height in the
+    same way as the loop in total_bounces. The power and the loop's repeated
+    multiplication can differ by a few ulps, which changes the answer when a
+    bounce height lands on the minimum height, so heights within
+    NEAR_TIE_ULPS of it are found again by multiplying one bounce at a time
+    as the loop does. Such near ties are rare, so this costs little.
+
+    Args:
+        initial_height : numpy array
+        minimum_height : numpy array
+        efficiency : numpy array
+        bounces : numpy array
+    Returns:
+        above: [numpy array of bool]
+    """
+    initial_height, minimum_height, efficiency, bounces = (
+        np.asarray(array, dtype=float) for array in
+        (initial_height, minimum_height, efficiency, bounces))
+    height = np.asarray(initial_height * efficiency**bounces)
+    near = np.abs(height - minimum_height) <= (
+        NEAR_TIE_ULPS * np.finfo(float).eps * np.abs(minimum_height))
+
+    if near.any():
+        near_height = initial_height[near]
+        near_efficiency = efficiency[near]
+        near_bounces = bounces[near]
+        for bounce in range(int(near_bounces.max())):
+            near_height = np.where(bounce < near_bounces,
+                                   near_height * near_efficiency, near_height)
+        height[near] = near_height
+
+    return height > minimum_height
+
+
+def bisect_increasing(function, target, lower, upper,
+                      tolerance=SOLVER_TOLERANCE,
+                      max_iterations=SOLVER_MAX_ITERATIONS):
+    """
+    Finds, for every target at once, the smallest x between lower and upper
+    where an increasing function reaches the target, by bisection. The
+    function is called as function(x, mask) and must return its values for
+    the entries of the targets selected by mask, which is Ellipsis for all of
+    them. Each iteration evaluates the function once on all the brackets that
+    have not yet converged.
+
+    Where the function already reaches the target at lower, lower is
+    returned. Where it does not reach the target at upper, nan is returned.
+
+    Args:
+        function : function
+        target : numpy array
+        lower : numpy array
+        upper : numpy array
+        tolerance : FLOAT
+            relative width of the bracket to stop at
+        max_iterations : int
+    Returns:
+        x: [numpy array]
+    """
+    target, lower, upper = (np.array(array, dtype=float) for array in
+                            np.broadcast_arrays(target, lower, upper))
+
+    at_lower = function(lower, Ellipsis) >= target
+    reached = function(upper, Ellipsis) >= target
+    active = reached & ~at_lower
+
+    for dummy in range(max_iterations):
+        if not active.any():
+            break
+        middle = (lower[active] + upper[active]) / 2
+        above = function(middle, active) >= target[active]
+
+        active_upper = upper[active]
+        active_lower = lower[active]
+        active_upper[above] = middle[above]
+        active_lower[~above] = middle[~above]
+        upper[active] = active_upper
+        lower[active] = active_lower
+
+        active[active] = (active_upper - active_lower >
+                          tolerance * np.abs(active_upper))
+
+    return np.where(at_lower, lower, np.where(reached, upper, np.nan))
+
+
+def efficiency_for_target(initial_height, minimum_height, target,
+                          quantity='bounces'):
+    """
+    Finds the smallest efficiency that gives a target number of bounces, or a
+    target total time in s, for each scenario. Heights are in meters. Every
+    efficiency up to the next bounce gives the same number of bounces.
+
+    The total time jumps each time a bounce is gained, so some time targets
+    cannot be hit exactly. These, and scenarios that do not satisfy the
+    boundary conditions, give nan.
+
+    Args:
+        initial_height : FLOAT or numpy array
+        minimum_height : FLOAT or numpy array
+        target : FLOAT or numpy array
+        quantity : string
+            'bounces' or 'time'. The default is 'bounces'.
+    Returns:
+        efficiency: [numpy array]
+    """
+    initial_height, minimum_height, target = (
+        np.array(array, dtype=float) for array in
+        np.broadcast_arrays(initial_height, minimum_height, target))
+
+    def result(efficiency, mask=Ellipsis):
+        return target_quantity(initial_height[mask], minimum_height[mask],
+                               efficiency, quantity)
+
+    efficiency = bisect_increasing(result, target, np.finfo(float).tiny, 1.)
+
+    return target_check(result(efficiency), target, efficiency, quantity)
+
+
+def initial_height_for_target(minimum_height, efficiency, target,
+                              quantity='bounces'):
+    """
+    Finds the smallest initial height that gives a target number of bounces,
+    or a target total time in s, for each scenario. Heights are in meters.
+    Every initial height up to the next bounce gives the same number of
+    bounces.
+
+    The total time jumps each time a bounce is gained, so some time targets
+    cannot be hit exactly. These, and scenarios that do not satisfy the
+    boundary conditions, give nan.
+
+    Args:
+        minimum_height : FLOAT or numpy array
+        efficiency : FLOAT or numpy array
+        target : FLOAT or numpy array
+        quantity : string
+            'bounces' or 'time'. The default is 'bounces'.
+    Returns:
+        initial_height: [numpy array]
+    """
+    minimum_height, efficiency, target = (
+        np.array(array, dtype=float) for array in
+        np.broadcast_arrays(minimum_height, efficiency, target))
+
+    def result(initial_height, mask=Ellipsis):
+        return target_quantity(initial_height, minimum_height[mask],
+                               efficiency[mask], quantity)
+
+    # Double the upper bracket until it reaches the target.
+    lower = np.maximum(minimum_height, 0.)
+    upper = np.maximum(2 * lower, 1.)
+    for dummy in range(SOLVER_MAX_ITERATIONS):
+        short = result(upper) < target
+        if not short.any():
+            break
+        upper[short] *= 2
+
+    initial_height = bisect_increasing(result, target, lower, upper)
+
+    return target_check(result(initial_height), target, initial_height,
+                        quantity)
+
+
+def target_quantity(initial_height, minimum_height, efficiency, quantity):
+    """
+    Returns the total number of bounces or the total time from bounce_engine.
+    Scenarios that do not satisfy the boundary conditions give -inf so the
+    solver moves away from them.
+
+    Args:
+        initial_height : numpy array
+        minimum_height : numpy array
+        efficiency : numpy array
+        quantity : string
+            'bounces' or 'time'
+    Returns:
+        numpy array
+    """
+    time, dummy, bounces = bounce_engine(initial_height, minimum_height,
+                                         efficiency)
+    if quantity == 'bounces':
+        value = bounces
+    elif quantity == 'time':
+        value = time
+    else:
+        raise ValueError("quantity must be 'bounces' or 'time'.")
+
+    return np.where(np.isnan(value), -np.inf, value)
+
+
+def target_check(value, target, solution, quantity):
+    """
+    Replaces solutions that do not hit their target with nan.
+
+    Args:
+        value : numpy array
+            bounces or time at the solution
+        target : numpy array
+        solution : numpy array
+        quantity : string
+            'bounces' or 'time'
+    Returns:
+        solution: [numpy array]
+    """
+    if quantity == 'bounces':
+        hit = value == target
+    else:
+        hit = np.isclose(value, target, rtol=TIME_TARGET_TOLERANCE, atol=0)
+
+    return np.where(hit, solution, np.nan)
+
+
+def fall_with_drag(height, drag_coefficient):
+    """
+    Calculates the time taken and the impact speed for a ball falling from
+    rest through a height with quadratic air drag, a = -g + k v^2. Heights
+    are in meters and the drag coefficient k is in 1/m. A drag coefficient
+    of zero gives free fall.
+
+    Args:
+        height : FLOAT
+        drag_coefficient : FLOAT
+    Returns:
+        time: [FLOAT]
+        speed: [FLOAT]
+    """
+    if drag_coefficient == 0:
+        return ((2 * height / ACCELERATION) ** 0.5,
+                (2 * ACCELERATION * height) ** 0.5)
+
+    terminal_speed = (ACCELERATION / drag_coefficient) ** 0.5
+    time = (terminal_speed / ACCELERATION) * np.arccosh(
+        np.exp(drag_coefficient * height))
+    speed = terminal_speed * np.sqrt(-np.expm1(-2 * drag_coefficient *
+                                               height))
+    return time, speed
+
+
+def rise_with_drag(speed, drag_coefficient):
+    """
+    Calculates the time taken and the apex height for a ball thrown upwards
+    with some speed with quadratic air drag, a = -g - k v^2. Speeds are in
+    m/s and the drag coefficient k is in 1/m. A drag coefficient of zero gives
+    free flight.
+
+    Args:
+        speed : FLOAT
+        drag_coefficient : FLOAT
+    Returns:
+        time: [FLOAT]
+        height: [FLOAT]
+    """
+    if drag_coefficient == 0:
+        return speed / ACCELERATION, speed**2 / (2 * ACCELERATION)
+
+    terminal_speed = (ACCELERATION / drag_coefficient) ** 0.5
+    time = (terminal_speed / ACCELERATION) * np.arctan(speed /
+                                                       terminal_speed)
+    height = np.log1p((speed / terminal_speed)**2) / (2 * drag_coefficient)
+    return time, height
+
+
+def bounce_events(initial_height, minimum_height, efficiency,
+                  drag_coefficient=0., time_limit=None):
+    """
+    Generates a record for every bounce above a specified minimum height, one
+    at a time, so only the current bounce is ever held in memory. Heights are
+    in meters. The efficiency is the fraction of kinetic energy kept at each
+    bounce, which without drag is the fraction of height kept.
+
+    Each record is a tuple matching BOUNCE_DTYPE:
+        bounce : the bounce number, starting at 1
+        time : the time the ball lands at the end of the bounce in s
+        apex_height : the highest point of the bounce in m
+        impact_velocity : the speed the ball lands with in m/s
+
+    Without drag the count and the last time match total_bounces and
+    total_time. With quadratic drag (drag_coefficient in 1/m) each rise and
+    fall is solved exactly. Use itertools.islice to take the first N
+    bounces, or time_limit to stop once the time passes a budget in s. With
+    no drag and an efficiency of 1 the generator never ends.
+
+    Args:
+        initial_height : FLOAT
+        minimum_height : FLOAT
+        efficiency : FLOAT
+        drag_coefficient : FLOAT
+            The default is 0.
+        time_limit : FLOAT
+            The default is None.
+    Returns:
+        generator of tuples
+    """
+    if not conditions_mask(initial_height, minimum_height, efficiency):
+        raise ValueError('The initial conditions do not satisfy the boundary'
+                         ' conditions.')
+
+    time, impact_velocity = fall_with_drag(initial_height, drag_coefficient)
+    apex_height = initial_height
+    bounce = 0
+
+    while time_limit is None or time <= time_limit:
+        if drag_coefficient == 0:
+            # Scale the height directly, as total_bounces does, so the
+            # bounce count is not changed by rounding at the boundary.
+            apex_height = apex_height * efficiency
+            rise_time = fall_with_drag(apex_height, 0)[0]
+        else:
+            launch_speed = impact_velocity * efficiency ** 0.5
+            rise_time, apex_height = rise_with_drag(launch_speed,
+                                                    drag_coefficient)
+
+        if apex_height <= minimum_height or apex_height == 0:
+            return
+
+        fall_time, impact_velocity = fall_with_drag(apex_height,
+                                                    drag_coefficient)
+        time = time + rise_time + fall_time
+        bounce += 1
+
+        if time_limit is not None and time > time_limit:
+            return
+
+        yield bounce, time, apex_height, impact_velocity
+
+
+def bounce_record_blocks(events, block_size=BLOCK_SIZE, out=None):
+    """
+    Fills a preallocated BOUNCE_DTYPE array from a stream of bounce records
+    and yields it each time it is full, and once more for the final partial
+    block. The same array is reused for every block, so the caller must copy
+    or write out a block before asking for the next one.
+
+    Args:
+        events : iterable of tuples
+            e.g. from bounce_events
+        block_size : int
+            The default is BLOCK_SIZE. Ignored if out is given.
+        out : numpy array with dtype BOUNCE_DTYPE
+            The default is None, which allocates one.
+    Returns:
+        generator of numpy arrays
+    """
+    if out is None:
+        out = np.empty(block_size, dtype=BOUNCE_DTYPE)
+
+    filled = 0
+    for event in events:
+        out[filled] = event
+        filled += 1
+        if filled == len(out):
+            yield out
+            filled = 0
+
+    if filled:
+        yield out[:filled]
+
+
 def average_speed(time, distance):
     """
     Calculates the average speed. Distance is in metres and the time is in s.
@@ -134,11 +596,10 @@ def bouncy_ball(initial_height, minimum_height, efficiency):
     J.Sharma 24/10/2020
     """
 
-    time = total_time(initial_height, minimum_height, efficiency)
-
-    distance = total_distance(initial_height, minimum_height, efficiency)
-
-    bounces = total_bounces(initial_height, minimum_height, efficiency)
+    time, distance, bounces = bounce_engine(initial_height, minimum_height,
+                                            efficiency)
+    time, distance = float(time), float(distance)
+    bounces = int(bounces) if np.isfinite(bounces) else float(bounces)
 
     speed = average_speed(time, distance)
 
@@ -162,6 +623,95 @@ def bouncy_ball(initial_height, minimum_height, efficiency):
         print('There were 0 bounces')
 
 
+def conditions_mask(initial_height, minimum_height, efficiency):
+    """
+    Vectorized form of the boundary conditions in initial_conditions_checker.
+    Returns True for every scenario that satisfies them.
+
+    The boundary conditions:
+        1) initial_height >= minimum height
+        2) 0 < efficiency <= 1
+
+    Args:
+        initial_height : FLOAT or numpy array
+        minimum_height : FLOAT or numpy array
+        efficiency : FLOAT or numpy array
+    Returns:
+        valid: [numpy array of bool]
+    """
+    initial_height = np.asarray(initial_height, dtype=float)
+    minimum_height = np.asarray(minimum_height, dtype=float)
+    efficiency = np.asarray(efficiency, dtype=float)
+
+    return ((initial_height >= minimum_height) & (efficiency > 0) &
+            (efficiency <= 1))
+
+
+def read_scenario_chunks(file, chunk_size=CHUNK_SIZE):
+    """
+    Reads scenarios from an open CSV file with the columns initial height,
+    minimum height and efficiency, chunk_size rows at a time. A header line
+    is skipped if present.
+
+    Args:
+        file : file object
+        chunk_size : int
+    Returns:
+        generator of numpy arrays of shape (rows, 3)
+    """
+    lines = (line for line in file if line.strip())
+    first_line = next(lines, None)
+    if first_line is None:
+        return
+    try:
+        float(first_line.split(',')[0])
+        lines = itertools.chain([first_line], lines)
+    except ValueError:
+        pass
+
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield np.loadtxt(chunk, delimiter=',', ndmin=2, usecols=(0, 1, 2))
+
+
+def batch_bouncy_ball(input_file, output_file, chunk_size=CHUNK_SIZE):
+    """
+    Streams scenarios from input_file to output_file without any prompts.
+    For every row the time, distance, number of bounces and average speed are
+    written, along with whether the row satisfies the boundary conditions.
+    Rows that do not are written with nan results. Only one chunk is held in
+    memory at a time.
+
+    Args:
+        input_file : file object
+        output_file : file object
+        chunk_size : int
+    Returns:
+        rows: [int]
+            number of scenarios processed
+    """
+    rows = 0
+    output_file.write(','.join(BATCH_COLUMNS) + '\n')
+
+    for chunk in read_scenario_chunks(input_file, chunk_size):
+        initial_height, minimum_height, efficiency = chunk.T
+        valid = conditions_mask(initial_height, minimum_height, efficiency)
+        time, distance, bounces = bounce_engine(initial_height,
+                                                minimum_height, efficiency)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = average_speed(time, distance)
+
+        np.savetxt(output_file,
+                   np.column_stack((chunk, valid, time, distance, bounces,
+                                    speed)),
+                   delimiter=',', fmt='%.10g')
+        rows += len(chunk)
+
+    return rows
+
+
 def initial_conditions_checker(initial_height, minimum_height, efficiency):
     """
     Checks the conditions of initial height, minimum height and efficiency are
@@ -203,16 +753,46 @@ def initial_conditions_checker(initial_height, minimum_height, efficiency):
 # MAIN CODE
 
 
-INITIAL_HEIGHT = float(input('What is the intial height in m? '))
-
-
-MINIMUM_HEIGHT = float(input('What is the minimum height in m? '))
-
-
-EFFICIENCY = float(input('What is the efficiency? '))
-
-
-initial_conditions_checker(INITIAL_HEIGHT, MINIMUM_HEIGHT, EFFICIENCY)
-
-
+def main(arguments=None):
+    """
+    Runs the batch mode if an input file is given, otherwise asks the user for
+    the initial conditions.
 
+    Args:
+        arguments : list of strings
+            The default is None, which reads the command line.
+    """
+    parser = argparse.ArgumentParser(description='Bouncy ball calculator.')
+    parser.add_argument('--batch', metavar='INPUT',
+                        help="CSV of initial height, minimum height and "
+                        "efficiency, or '-' for stdin")
+    parser.add_argument('--output', default='-',
+                        help="output CSV, or '-' for stdout")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    arguments = parser.parse_args(arguments)
+
+    if arguments.batch is not None:
+        input_file = (sys.stdin if arguments.batch == '-'
+                      else open(arguments.batch, 'r'))
+        output_file = (sys.stdout if arguments.output == '-'
+                       else open(arguments.output, 'w'))
+        try:
+            batch_bouncy_ball(input_file, output_file, arguments.chunk_size)
+        finally:
+            if input_file is not sys.stdin:
+                input_file.close()
+            if output_file is not sys.stdout:
+                output_file.close()
+        return
+
+    initial_height = float(input('What is the intial height in m? '))
+
+    minimum_height = float(input('What is the minimum height in m? '))
+
+    efficiency = float(input('What is the efficiency? '))
+
+    initial_conditions_checker(initial_height, minimum_height, efficiency)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,39 +16,294 @@ Last Updated: 16/12/2020
 """
 # IMPORT STATEMENTS
 
+import argparse
+import contextlib
+import contextvars
+import csv
+import glob
+import hashlib
+import itertools
+import json
+import os
+import sys
+from time import perf_counter
+import tracemalloc
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mtick
-import scipy.constants as pc
-from scipy.optimize import fmin
+# matplotlib, scipy.optimize and scipy.constants are imported where they are
+# used, so importing this module only loads numpy.
 
 # CONSTANTS
 
 
 DATA_FILE_1 = 'doppler_data_1.csv'
 DATA_FILE_2 = 'doppler_data_2.csv'
-SPEED_OF_LIGHT_VACUMN = pc.speed_of_light  # m/s
+DATA_CACHE_DIRECTORY = '.doppler_cache'
+READ_CHUNK_ROWS = 100000
+NUMERIC_CHARACTERS = b'0123456789.eE+-, \t\r\n'
 EMITTED_WAVELENGHT = 656.281 * 10**-9  # m
-GRAVITATIONAL_CONSTANT = pc.G  # Nm^2/kg^2
 MASS_OF_STAR = 2.78 * 1.989 * 10**30  # Kg
 PHASE_START = 3  # rad
 SPEED_STAR_START = 50  # m/s
 ANGULAR_SPEED_START = 3 * 10**-8  # rad/s
+KEPLER_ITERATIONS = 8  # Halley steps, enough for eccentricity up to 0.999
+KEPLER_MINIMISATION_ITERATIONS_PER_PARAMETER = 1000
 X_VALUES_SHIFT_CONTOUR_PLOT = 3  # m/s
 Y_VALUES_SHIFT_CONTOUR_PLOT = 1 * 10**-9  # rad/s
 NUMBER_OF_POINTS_CONTOUR_PLOT = 500
+CONTOUR_BASE_CELLS = 16  # cells along each side of the coarsest grid
+CONTOUR_REFINEMENT_DEPTH = 5  # halvings of the crossing cells
+CONTOUR_WINDOW_MARGIN = 1.5  # window / quadratic estimate of the contour
+CONTOUR_WINDOW_MAX_GROWTH = 30  # doublings of the window
+CHI_SQUARED_CHUNK_ELEMENTS = 2**16  # largest temporary array when chunking
+OUT_OF_CORE_BLOCK_ROWS = 2**20  # rows read at a time from disk
+SEPARABLE_FIT_TOLERANCE = 1 * 10**-12  # relative step in angular speed
+SEPARABLE_FIT_MAX_ITERATIONS = 100
+PERIODOGRAM_OVERSAMPLING = 5
+PERIODOGRAM_MAX_POINTS = 2**12  # trial angular speeds, whatever the data size
+PERIODOGRAM_MAX_DATA_POINTS = 10**4  # above this the fit starts from
+# ANGULAR_SPEED_START instead of the periodogram
+PERIODOGRAM_PEAKS = 3
+SIGMA_CLIP_MAX_ITERATIONS = 100
+OUTLIER_CLIP_ITERATIONS = 1  # one pass, as the original outlier removal
+PROFILE_BRACKET_MAX_ITERATIONS = 60  # doublings of the root bracket
+MCMC_WALKERS = 32
+MCMC_STEPS = 2000
+MCMC_STRETCH = 2  # scale of the affine invariant stretch move
+MCMC_CHECKPOINT_STEPS = 500
+MCMC_START_SPREAD = 10**-4  # relative spread of the starting walkers
+MONTE_CARLO_SAMPLES = 10**6
+# Percentiles of the median and the one standard deviation interval
+MONTE_CARLO_PERCENTILES = (15.865525393145708, 50, 84.13447460685429)
+PROPAGATED_QUANTITIES = ('speed_star', 'angular_speed',
+                         'planet_distance_from_star', 'velocity_of_planet',
+                         'mass_of_planet')
 MINIMUM_CHI_SQUARED_OFFSET_1 = 1
 MINIMUM_CHI_SQUARED_OFFSET_2 = 2.3
 MINIMUM_CHI_SQUARED_OFFSET_3 = 5.99
 MINIMUM_CHI_SQUARED_OFFSET_4 = 9.21
+CONTOUR_OFFSETS = (MINIMUM_CHI_SQUARED_OFFSET_1, MINIMUM_CHI_SQUARED_OFFSET_2,
+                   MINIMUM_CHI_SQUARED_OFFSET_3, MINIMUM_CHI_SQUARED_OFFSET_4)
 YEARS_TO_SECONDS_CONVERSION = 3.154 * 10**7
 NANOMETERS_TO_METERS_CONVERSION = 10**-9
-METERS_TO_AU_CONVERSION = pc.au
 KILOGRAMS_TO_JOVIAN_MASS_CONVERSION = 1.8986 * 10**27
+BATCH_RESULTS_FILE = 'doppler_results.csv'
+PROFILE_ENVIRONMENT_VARIABLE = 'DOPPLER_PROFILE'  # holds the report file
+PROFILE_REPORT_FILE = 'doppler_profile.json'
+STAR_RESULT_COLUMNS = ('name', 'status', 'number_of_points', 'speed_star',
+                       'speed_star_uncertainty', 'angular_speed',
+                       'angular_speed_uncertainty', 'phase',
+                       'planet_distance_from_star_au',
+                       'planet_distance_from_star_uncertainty_au',
+                       'velocity_of_planet', 'velocity_of_planet_uncertainty',
+                       'mass_of_planet_jovian_mass',
+                       'mass_of_planet_uncertainty_jovian_mass',
+                       'reduced_chi_squared')
 
 # FUNCTIONS
 
 
+# Holds the report while a run is being profiled, None otherwise.
+PROFILE_REPORT = contextvars.ContextVar('profile_report', default=None)
+
+
+def profile_start():
+    """
+    Starts recording the wall time and peak memory allocation of each stage
+    and counting chi squared evaluations and fit iterations. Until this is
+    called the profile_ functions return straight away. Use profiling, which
+    always stops again, rather than calling this directly.
+
+    Returns
+    -------
+    token : contextvars.Token
+        passed to profile_stop
+
+    """
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    return PROFILE_REPORT.set({'started': perf_counter(),
+                               'lap': perf_counter(),
+                               'stages': [], 'evaluations': {}, 'fits': [],
+                               'stars': {}, 'tracing': tracing})
+
+
+def profile_lap(stage, **sizes):
+    """
+    Records the wall time and peak allocation since the previous lap as one
+    stage.
+
+    Parameters
+    ----------
+    stage : string
+    **sizes : ints
+        array sizes to record with the stage
+
+    Returns
+    -------
+    None.
+
+    """
+    profile_report = PROFILE_REPORT.get()
+    if profile_report is None:
+        return
+    seconds = perf_counter() - profile_report['lap']
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    profile_report['stages'].append(dict(stage=stage, seconds=seconds,
+                                         peak_bytes=peak_bytes, **sizes))
+    profile_report['lap'] = perf_counter()
+
+
+def profile_count(function_name, number=1):
+    """
+    Adds number chi squared evaluations to the count for function_name.
+
+    Parameters
+    ----------
+    function_name : string
+    number : int
+        The default is 1.
+
+    Returns
+    -------
+    None.
+
+    """
+    profile_report = PROFILE_REPORT.get()
+    if profile_report is None:
+        return
+    evaluations = profile_report['evaluations']
+    evaluations[function_name] = evaluations.get(function_name, 0) + number
+
+
+def profile_fit(function_name, iterations, evaluations, warnflag,
+                number_of_points):
+    """
+    Records the iterations and function evaluations of one fit.
+
+    Parameters
+    ----------
+    function_name : string
+    iterations : int
+    evaluations : int
+    warnflag : int
+    number_of_points : int
+
+    Returns
+    -------
+    None.
+
+    """
+    profile_report = PROFILE_REPORT.get()
+    if profile_report is None:
+        return
+    profile_report['fits'].append({'function': function_name,
+                                   'iterations': int(iterations),
+                                   'evaluations': int(evaluations),
+                                   'warnflag': int(warnflag),
+                                   'number_of_points': int(number_of_points)})
+
+
+def profile_star(name, report):
+    """
+    Records the report of one star of a batch, profiled in its worker.
+
+    Parameters
+    ----------
+    name : string
+    report : dict
+
+    Returns
+    -------
+    None.
+
+    """
+    profile_report = PROFILE_REPORT.get()
+    if profile_report is None:
+        return
+    profile_report['stars'][name] = report
+
+
+def profile_stop(token, report_file=PROFILE_REPORT_FILE):
+    """
+    Stops profiling and writes the report as JSON, to the standard output if
+    report_file is '-'. Nothing is written if report_file is None.
+
+    Parameters
+    ----------
+    token : contextvars.Token
+        returned by profile_start
+    report_file : string
+        The default is PROFILE_REPORT_FILE.
+
+    Returns
+    -------
+    report : dict
+
+    """
+    profile_report = PROFILE_REPORT.get()
+    report = {'total_seconds': (perf_counter() -
+                                profile_report['started']),
+              'peak_bytes': max([stage['peak_bytes'] for stage in
+                                 profile_report['stages']] +
+                                [tracemalloc.get_traced_memory()[1]]),
+              'stages': profile_report['stages'],
+              'evaluations': profile_report['evaluations'],
+              'fits': profile_report['fits']}
+    if profile_report['stars']:
+        report['stars'] = profile_report['stars']
+    if not profile_report['tracing']:
+        tracemalloc.stop()
+    PROFILE_REPORT.reset(token)
+
+    if report_file is None:
+        return report
+    if report_file == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(report_file, 'w') as file:
+            json.dump(report, file, indent=1)
+
+    return report
+
+
+@contextlib.contextmanager
+def profiling(report_file=PROFILE_REPORT_FILE, enabled=True):
+    """
+    Profiles the body of a with statement as profile_start and profile_stop
+    do. Profiling is stopped and the report written even if the body raises,
+    so tracemalloc is never left running. The report is put in the yielded
+    dict on exit.
+
+    Parameters
+    ----------
+    report_file : string
+        The default is PROFILE_REPORT_FILE.
+    enabled : bool
+        The default is True. When False nothing is profiled.
+
+    Yields
+    ------
+    report : dict
+        empty until the with statement ends
+
+    """
+    report = {}
+    if not enabled:
+        yield report
+        return
+    token = profile_start()
+    try:
+        yield report
+    finally:
+        report.update(profile_stop(token, report_file))
+
+
 def is_float(entry):
     """
     Checks if the entry is a float.
@@ -82,13 +337,215 @@ def file_check(filename):
     -------
     bool
     """
-    try:
-        file = open(filename, 'r')
-        file.close()
+    if os.path.isfile(filename):
         return True
-    except FileNotFoundError:
-        print("'{0:s}' not found. Please check directory.".format(filename))
-        return False
+    print("'{0:s}' not found. Please check directory.".format(filename))
+    return False
+
+
+def data_file_list(files):
+    """
+    Expands a glob pattern, or a list of file names and glob patterns, into a
+    sorted list of file names. Names without wildcards are kept as they are.
+
+    Parameters
+    ----------
+    files : string or list of strings
+
+    Returns
+    -------
+    filenames : list of strings
+    """
+    if isinstance(files, str):
+        files = [files]
+
+    filenames = []
+    for pattern in files:
+        if glob.has_magic(pattern):
+            filenames.extend(sorted(glob.glob(pattern)))
+        else:
+            filenames.append(pattern)
+    return filenames
+
+
+def clean_data(data_array):
+    """
+    Removes rows containing non-numeric values or a zero uncertainty.
+
+    Parameters
+    ----------
+    data_array : numpy array
+
+    Returns
+    -------
+    data_array : numpy array
+    """
+    return data_array[~np.isnan(data_array).any(axis=1) &
+                      (data_array[:, 2] != 0)]
+
+
+def parse_data_file(filename, chunk_rows=READ_CHUNK_ROWS):
+    """
+    Reads a comma separated data file chunk_rows lines at a time and cleans
+    each chunk as it is read. Chunks are parsed with the fast np.loadtxt
+    reader. If a chunk has lines with other characters than numbers, e.g.
+    comments or failed readings, only those lines are parsed with
+    np.genfromtxt, which reads non-numeric entries as nan so clean_data
+    removes them. Anything still unreadable falls back to np.genfromtxt for
+    the whole chunk.
+
+    Parameters
+    ----------
+    filename : string
+    chunk_rows : int
+        The default is READ_CHUNK_ROWS.
+
+    Returns
+    -------
+    data_array : numpy array
+    """
+    chunks = []
+    with open(filename, 'r') as file:
+        while True:
+            lines = list(itertools.islice(file, chunk_rows))
+            if not lines:
+                break
+            try:
+                with warnings.catch_warnings():
+                    # A chunk of only comments or blank lines is empty.
+                    warnings.simplefilter('ignore', UserWarning)
+                    chunk = np.loadtxt(lines, delimiter=',', ndmin=2)
+            except ValueError:
+                chunk = parse_mixed_lines(lines)
+            else:
+                chunk = clean_data(chunk) if chunk.size else chunk
+            if chunk.size:
+                chunks.append(chunk)
+
+    if not chunks:
+        return np.empty((0, 3))
+    return np.concatenate(chunks)
+
+
+def parse_mixed_lines(lines):
+    """
+    Parses and cleans lines of a data file where some lines are not purely
+    numeric. The non-numeric lines are found with one vectorized pass over
+    the characters and are parsed separately with np.genfromtxt.
+
+    Parameters
+    ----------
+    lines : list of strings
+
+    Returns
+    -------
+    data_array : numpy array
+    """
+    characters = np.frombuffer(''.join(lines).encode(), dtype=np.uint8)
+    allowed = np.zeros(256, dtype=bool)
+    allowed[np.frombuffer(NUMERIC_CHARACTERS, dtype=np.uint8)] = True
+    newlines = characters == ord('\n')
+    line_of_character = np.cumsum(newlines) - newlines
+    odd_lines = np.zeros(len(lines), dtype=bool)
+    odd_lines[line_of_character[~allowed[characters]]] = True
+
+    numeric_lines = [line for line, odd in zip(lines, odd_lines)
+                     if not odd and line.strip()]
+    other_lines = [line for line, odd in zip(lines, odd_lines)
+                   if odd and not line.lstrip().startswith('#')]
+
+    try:
+        numeric = (np.loadtxt(numeric_lines, delimiter=',', ndmin=2)
+                   if numeric_lines else np.empty((0, 3)))
+        other = (clean_data(np.genfromtxt(other_lines, delimiter=',',
+                                          ndmin=2))
+                 if other_lines else np.empty((0, 3)))
+    except (ValueError, IndexError):
+        return clean_data(np.genfromtxt(lines, delimiter=',', ndmin=2))
+
+    if other.size:
+        # Rare rows such as inf survive cleaning; parse the chunk in order.
+        return clean_data(np.genfromtxt(lines, delimiter=',', ndmin=2))
+    return clean_data(numeric)
+
+
+def data_cache_path(filename, cache_directory=DATA_CACHE_DIRECTORY):
+    """
+    Returns the path of the cleaned .npy cache of a data file. The name
+    depends on the file's path, modification time and size, so a changed
+    file gets a new cache.
+
+    Parameters
+    ----------
+    filename : string
+    cache_directory : string
+        The default is DATA_CACHE_DIRECTORY.
+
+    Returns
+    -------
+    path : string
+    """
+    status = os.stat(filename)
+    key = '{0:s}|{1:d}|{2:d}'.format(os.path.abspath(filename),
+                                     status.st_mtime_ns, status.st_size)
+    return os.path.join(cache_directory, '{0:s}-{1:s}.npy'.format(
+        os.path.basename(filename),
+        hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+
+def read_data_cached(filename, cache_directory=DATA_CACHE_DIRECTORY):
+    """
+    Returns the cleaned data of a file, memory-mapped from its .npy cache.
+    The file is parsed and the cache written only if there is no cache for
+    this version of the file.
+
+    Parameters
+    ----------
+    filename : string
+    cache_directory : string
+        The default is DATA_CACHE_DIRECTORY.
+
+    Returns
+    -------
+    data_array : numpy memmap
+        read only
+    """
+    cache_path = data_cache_path(filename, cache_directory)
+
+    if not os.path.isfile(cache_path):
+        os.makedirs(cache_directory, exist_ok=True)
+        temporary_path = '{0:s}.{1:d}.tmp.npy'.format(cache_path,
+                                                      os.getpid())
+        np.save(temporary_path, parse_data_file(filename))
+        os.replace(temporary_path, cache_path)
+
+    return np.load(cache_path, mmap_mode='r')
+
+
+def read_data_files(files, cache_directory=DATA_CACHE_DIRECTORY):
+    """
+    Reads and cleans many data files, given as a glob pattern or a list of
+    file names and patterns, and stacks them into one array. With a cache
+    directory each file is only parsed once; later reads memory-map the
+    cache.
+
+    Parameters
+    ----------
+    files : string or list of strings
+    cache_directory : string
+        The default is DATA_CACHE_DIRECTORY. Use None to always parse.
+
+    Returns
+    -------
+    data_array : numpy array
+    """
+    arrays = [read_data(filename) if cache_directory is None
+              else read_data_cached(filename, cache_directory)
+              for filename in data_file_list(files)]
+
+    if len(arrays) == 1:
+        return arrays[0]
+    return np.concatenate(arrays)
 
 
 def read_data(filename):
@@ -104,14 +561,11 @@ def read_data(filename):
     -------
     data_array : numpy array
     """
-    data_array = np.genfromtxt(filename, delimiter=',')
-    data_array = data_array[~np.isnan(data_array).any(axis=1)]
-    data_array = data_array[data_array[:, 2] != 0, :]
+    return parse_data_file(filename)
 
-    return data_array
 
-
-def star_velocity_calculator(observed_wavelenght):
+def star_velocity_calculator(observed_wavelenght,
+                             emitted_wavelenght=EMITTED_WAVELENGHT):
     """
     Calculates the star velocity given the observed wavelenght.
 
@@ -119,6 +573,8 @@ def star_velocity_calculator(observed_wavelenght):
     ----------
     observed_wavelenght : float
         meters.
+    emitted_wavelenght : float
+        meters. The default is EMITTED_WAVELENGHT.
 
     Returns
     -------
@@ -126,8 +582,36 @@ def star_velocity_calculator(observed_wavelenght):
         meters / second
 
     """
-    return SPEED_OF_LIGHT_VACUMN * (((observed_wavelenght) /
-                                     (EMITTED_WAVELENGHT)) - 1)
+    from scipy.constants import speed_of_light
+
+    return speed_of_light * (((observed_wavelenght) /
+                              (emitted_wavelenght)) - 1)
+
+
+def star_velocity_uncertainty_calculator(
+        observed_wavelenght_uncertainty,
+        emitted_wavelenght=EMITTED_WAVELENGHT):
+    """
+    Calculates the uncertainty on the star velocity given the uncertainty on
+    the observed wavelenght.
+
+    Parameters
+    ----------
+    observed_wavelenght_uncertainty : float
+        meters.
+    emitted_wavelenght : float
+        meters. The default is EMITTED_WAVELENGHT.
+
+    Returns
+    -------
+    star velocity uncertainty: float
+        meters / second
+
+    """
+    from scipy.constants import speed_of_light
+
+    return np.abs((speed_of_light / emitted_wavelenght) *
+                  observed_wavelenght_uncertainty)
 
 
 def star_velocity(speed_star, angular_speed, phase, time):
@@ -155,7 +639,79 @@ def star_velocity(speed_star, angular_speed, phase, time):
     return speed_star * np.sin((angular_speed * time) + phase)
 
 
-def planet_distance_from_star_calculator(angular_speed):
+def kepler_solver(mean_anomaly, eccentricity, iterations=KEPLER_ITERATIONS):
+    """
+    Solves Kepler's equation M = E - e sin(E) for the eccentric anomaly E, for
+    whole arrays at once, with a fixed number of Halley steps from Danby's
+    starting guess.
+
+    Parameters
+    ----------
+    mean_anomaly : numpy array
+        rad
+    eccentricity : numpy array
+        broadcasts against mean_anomaly, 0 <= e < 1
+    iterations : int
+        The default is KEPLER_ITERATIONS.
+
+    Returns
+    -------
+    eccentric_anomaly : numpy array
+        rad
+
+    """
+    mean_anomaly = np.mod(mean_anomaly, 2 * np.pi)
+    eccentric_anomaly = mean_anomaly + 0.85 * eccentricity * np.sign(
+        np.sin(mean_anomaly))
+
+    for dummy in range(iterations):
+        eccentric_sine = eccentricity * np.sin(eccentric_anomaly)
+        eccentric_cosine = eccentricity * np.cos(eccentric_anomaly)
+        function = eccentric_anomaly - eccentric_sine - mean_anomaly
+        derivative = 1 - eccentric_cosine
+        eccentric_anomaly = eccentric_anomaly - 2 * function * derivative / (
+            2 * derivative**2 - function * eccentric_sine)
+
+    return eccentric_anomaly
+
+
+def keplerian_velocity(planets, time):
+    """
+    Calculates the star velocity due to any number of planets on Keplerian
+    orbits, summing K (cos(true anomaly + w_peri) + e cos(w_peri)) over the
+    planets. Every planet and time is solved at once by kepler_solver.
+
+    Parameters
+    ----------
+    planets : numpy array
+        one row per planet of [K (m/s), P (s), e, w_peri (rad),
+        T_peri (s)]
+    time : numpy array
+        seconds
+
+    Returns
+    -------
+    star velocity : numpy array
+        meters / second
+
+    """
+    planets = np.atleast_2d(planets)
+    (semi_amplitude, period, eccentricity, periastron_argument,
+     periastron_time) = (planets[:, index, np.newaxis] for index in range(5))
+
+    eccentric_anomaly = kepler_solver(
+        2 * np.pi * (time - periastron_time) / period, eccentricity)
+    true_anomaly = 2 * np.arctan2(
+        np.sqrt(1 + eccentricity) * np.sin(eccentric_anomaly / 2),
+        np.sqrt(1 - eccentricity) * np.cos(eccentric_anomaly / 2))
+
+    return np.sum(semi_amplitude * (
+        np.cos(true_anomaly + periastron_argument) +
+        eccentricity * np.cos(periastron_argument)), axis=0)
+
+
+def planet_distance_from_star_calculator(angular_speed,
+                                         mass_of_star=MASS_OF_STAR):
     """
     Calculates the planets distance from the star given the angular speed.
 
@@ -163,6 +719,8 @@ def planet_distance_from_star_calculator(angular_speed):
     ----------
     angular_speed : float
         rad / second
+    mass_of_star : float
+        kilograms. The default is MASS_OF_STAR.
 
     Returns
     -------
@@ -170,11 +728,12 @@ def planet_distance_from_star_calculator(angular_speed):
         meters
 
     """
-    return np.cbrt((GRAVITATIONAL_CONSTANT * MASS_OF_STAR) /
-                   (angular_speed**2))
+    from scipy.constants import G
 
+    return np.cbrt((G * mass_of_star) / (angular_speed**2))
 
-def velocity_of_planet_calculator(planet_distance):
+
+def velocity_of_planet_calculator(planet_distance, mass_of_star=MASS_OF_STAR):
     """
     Calculates the velocity of the planet given the planets distance from the
     star.
@@ -183,6 +742,8 @@ def velocity_of_planet_calculator(planet_distance):
     ----------
     planet_distance : float
         meters
+    mass_of_star : float
+        kilograms. The default is MASS_OF_STAR.
 
     Returns
     -------
@@ -190,10 +751,13 @@ def velocity_of_planet_calculator(planet_distance):
         meters / second
 
     """
-    return np.sqrt((GRAVITATIONAL_CONSTANT * MASS_OF_STAR) / (planet_distance))
+    from scipy.constants import G
+
+    return np.sqrt((G * mass_of_star) / (planet_distance))
 
 
-def mass_of_planet_calculator(speed_star, velocity_of_planet):
+def mass_of_planet_calculator(speed_star, velocity_of_planet,
+                              mass_of_star=MASS_OF_STAR):
     """
     Calculates the mass of the planet given the magnitue of the star velocity
     and the velocity of the planet.
@@ -204,6 +768,8 @@ def mass_of_planet_calculator(speed_star, velocity_of_planet):
         meters / second
     velocity_of_planet : float
         meters / second
+    mass_of_star : float
+        kilograms. The default is MASS_OF_STAR.
 
     Returns
     -------
@@ -211,140 +777,567 @@ def mass_of_planet_calculator(speed_star, velocity_of_planet):
         kilograms
 
     """
-    return (MASS_OF_STAR * speed_star) / velocity_of_planet
+    return (mass_of_star * speed_star) / velocity_of_planet
 
 
-def minimisation(data, number_of_variables, phase=None):
+def minimisation(data, number_of_variables, phase=None, planets=None,
+                 block_size=None):
     """
     Minimises the chi-squared of the star velocity with respect to two or
-    three variables.
+    three variables, or with respect to every parameter of a Keplerian
+    multi-planet model when planets is given. With block_size the chi
+    squared and its gradient are accumulated by chi_squared_out_of_core, so
+    the data can be memory-mapped columns larger than memory, and minimised
+    by L-BFGS-B, which needs far fewer passes over the data than the
+    simplex. The variables are scaled by their start values for it.
 
     Parameters
     ----------
     data : list
     number_of_variables : int
         Use 2 or 3 to minimise with respect to two or three variables
-        respectively.
+        respectively. Ignored when planets is given.
     phase : float
         The default is None.
+    planets : numpy array
+        start values, one row per planet of [K, P, e, w_peri, T_peri] as in
+        keplerian_velocity. The default is None.
+    block_size : int
+        rows per block, e.g. OUT_OF_CORE_BLOCK_ROWS. The default is None,
+        which evaluates the whole data set at once.
 
     Returns
     -------
     fit : tuple
+        for planets, fit[0] is flat; reshape it to (planets, 5)
 
     """
-    if number_of_variables == 3:
+    from scipy.optimize import fmin
+
+    if planets is not None:
+        planets = np.atleast_2d(planets)
+
+        def keplerian_chi_squared(parameters):
+            parameters = parameters.reshape(planets.shape)
+            if np.any((parameters[:, 1] <= 0) | (parameters[:, 2] < 0) |
+                      (parameters[:, 2] >= 1)):
+                return np.inf
+            return chi_squared_calculator(
+                keplerian_velocity(parameters, data[0]), data[1], data[2])
+
+        fit = fmin(keplerian_chi_squared, planets.ravel(), full_output=True,
+                   maxiter=KEPLER_MINIMISATION_ITERATIONS_PER_PARAMETER *
+                   planets.size,
+                   maxfun=KEPLER_MINIMISATION_ITERATIONS_PER_PARAMETER *
+                   planets.size)
+
+    elif block_size is not None:
+        from scipy.optimize import minimize
+
+        scale = np.array([SPEED_STAR_START,
+                          ANGULAR_SPEED_START,
+                          PHASE_START][:number_of_variables])
+
+        def scaled_chi_squared(x):
+            chi_squared, chi_squared_gradient = chi_squared_out_of_core(
+                x * scale, data, None if number_of_variables == 3 else phase,
+                block_size, gradient=True)
+            return chi_squared, chi_squared_gradient * scale
+
+        result = minimize(scaled_chi_squared, np.ones(number_of_variables),
+                          jac=True, method='L-BFGS-B')
+        # the same layout as the full output of fmin
+        fit = (result.x * scale, result.fun, result.nit, result.nfev,
+               result.status)
+
+    elif number_of_variables == 3:
         fit = fmin(lambda x: chi_squared_calculator(star_velocity(
             x[0], x[1], x[2], data[0]), data[1], data[2]),
                    [SPEED_STAR_START,
                     ANGULAR_SPEED_START,
                     PHASE_START], full_output=True)
 
-    if number_of_variables == 2:
+    elif number_of_variables == 2:
         fit = fmin(lambda x: chi_squared_calculator(star_velocity(
             x[0], x[1], phase, data[0]), data[1], data[2]),
                    [SPEED_STAR_START,
                     ANGULAR_SPEED_START], full_output=True)
 
+    profile_fit('minimisation', fit[2], fit[3], fit[4], len(data[0]))
     return fit
 
 
-def remove_outliers_1(data, number_of_standard_deviations):
+def separable_chi_squared(data, angular_speed):
     """
-    Removes outliers from some data set that are more than a number of standard
-    deviations away from the mean.
+    Fits the star velocity v0 sin(w t + phase) = a sin(w t) + b cos(w t) for a
+    fixed angular speed. The amplitudes a and b enter linearly, so they are
+    found exactly by weighted linear least squares. The derivatives of the
+    chi squared with respect to the angular speed, with the amplitudes kept
+    at their best values, are found analytically.
 
     Parameters
     ----------
-    data : numpy array of floats
-    number_of_standard_deviations : int
-        sets the tolerance
+    data : list
+        [time, star velocity, uncertainty]
+    angular_speed : float
+        rad / second
 
     Returns
     -------
-    data_first_cleaning : numpy array
+    chi_squared : float
+    gradient : float
+        d chi^2 / dw
+    curvature : float
+        Gauss-Newton estimate of d^2 chi^2 / dw^2
+    amplitudes : numpy array
+        [a, b]
 
     """
-    index = 0
-    idx = []
-    means = np.mean(data, 0)[1]
-    standard_deviation = np.std(data, 0)[1]
-    for line in data[:, 1]:
-        if line < means - (number_of_standard_deviations *
-                           standard_deviation) or\
-                line > means + (number_of_standard_deviations *
-                                standard_deviation):
-            idx.append(index)
-        index += 1
-    data_first_cleaning = np.delete(data, idx, axis=0)
+    profile_count('separable_chi_squared')
+    time, velocity, uncertainty = data[0], data[1], data[2]
+    weights = 1 / uncertainty**2
+    sine = np.sin(angular_speed * time)
+    cosine = np.cos(angular_speed * time)
 
-    return data_first_cleaning
+    basis = np.vstack((sine, cosine))
+    normal_matrix = (basis * weights) @ basis.T
+    amplitudes = np.linalg.solve(normal_matrix,
+                                 (basis * weights) @ velocity)
 
+    residuals = amplitudes @ basis - velocity
+    derivative = time * (amplitudes[0] * cosine - amplitudes[1] * sine)
 
-def remove_outliers_2(data, number_of_standard_deviations,
-                      speed_star, angular_speed, phase):
+    chi_squared = np.sum(weights * residuals**2)
+    gradient = 2 * np.sum(weights * residuals * derivative)
+    cross_terms = (basis * weights) @ derivative
+    curvature = 2 * (np.sum(weights * derivative**2) -
+                     cross_terms @ np.linalg.solve(normal_matrix,
+                                                   cross_terms))
+
+    return chi_squared, gradient, curvature, amplitudes
+
+
+def separable_fit(data, angular_speed_start=ANGULAR_SPEED_START):
     """
-    Removes data points that are far away from the line of best fit. This must
-    be run after points that are far away from the mean are removed.
+    Minimises the chi-squared of the star velocity with respect to the speed
+    of the star, angular speed and phase. Only the angular speed is searched,
+    by Newton steps on separable_chi_squared; the speed of the star and the
+    phase follow exactly from the linear amplitudes, so no start values are
+    needed for them.
 
     Parameters
     ----------
-    data : numpy array of floats
-    number_of_standard_deviations : int
-        sets the tolerance
-    speed_star : numpy float64
-    angular_speed : numpy float64
-    phase : numpy float64
+    data : list
+        [time, star velocity, uncertainty]
+    angular_speed_start : float
+        rad / second. The default is ANGULAR_SPEED_START.
 
     Returns
     -------
-    data_second_cleaning : numpy array
+    fit : tuple
+        (numpy array of [speed_star, angular_speed, phase], minimum chi
+        squared, iterations, chi squared evaluations, warnflag) in the same
+        layout as minimisation.
 
     """
+    angular_speed = angular_speed_start
+    chi_squared, gradient, curvature, amplitudes = separable_chi_squared(
+        data, angular_speed)
+    evaluations = 1
+    warnflag = 1
+
+    for iterations in range(1, SEPARABLE_FIT_MAX_ITERATIONS + 1):
+        step = -gradient / curvature if curvature > 0 else -np.sign(
+            gradient) * SEPARABLE_FIT_TOLERANCE * abs(angular_speed)
+
+        # Halve the step until the chi squared goes down.
+        while True:
+            trial = separable_chi_squared(data, angular_speed + step)
+            evaluations += 1
+            if trial[0] <= chi_squared or abs(step) <= (
+                    SEPARABLE_FIT_TOLERANCE * abs(angular_speed)):
+                break
+            step /= 2
+
+        if trial[0] <= chi_squared:
+            angular_speed += step
+            chi_squared, gradient, curvature, amplitudes = trial
+
+        if abs(step) <= SEPARABLE_FIT_TOLERANCE * abs(angular_speed):
+            warnflag = 0
+            break
+
+    speed_star = np.hypot(amplitudes[0], amplitudes[1])
+    phase = np.mod(np.arctan2(amplitudes[1], amplitudes[0]), 2 * np.pi)
+
+    profile_fit('separable_fit', iterations, evaluations, warnflag,
+                len(data[0]))
+    return (np.array([speed_star, angular_speed, phase]), chi_squared,
+            iterations, evaluations, warnflag)
+
+
+def angular_speed_grid(time, oversampling=PERIODOGRAM_OVERSAMPLING,
+                       maximum_angular_speed=None,
+                       maximum_points=PERIODOGRAM_MAX_POINTS):
+    """
+    Returns an evenly spaced grid of angular speeds to search for a signal.
+    The grid has a spacing of 2 pi / (oversampling * baseline) and runs from
+    one step up to the pseudo-Nyquist angular speed of the median sampling
+    interval, so orbits a little longer than the baseline are still found.
+    It stops after maximum_points, keeping the longest orbits, so the
+    periodogram costs O(maximum_points * N) rather than O(N^2).
+
+    Parameters
+    ----------
+    time : numpy array
+        seconds
+    oversampling : int
+        The default is PERIODOGRAM_OVERSAMPLING.
+    maximum_angular_speed : float
+        rad / second. The default is None, which uses the pseudo-Nyquist
+        angular speed.
+    maximum_points : int
+        The default is PERIODOGRAM_MAX_POINTS.
 
-    standard_deviation = np.std(data[:, 1], ddof=1)
-    rows_with_errors = []
+    Returns
+    -------
+    angular_speeds : numpy array
+        rad / second
 
-    for line in range(len(data[:])):
+    """
+    step = 2 * np.pi / (oversampling * np.ptp(time))
+    if maximum_angular_speed is None:
+        maximum_angular_speed = np.pi / np.median(np.diff(np.sort(time)))
 
-        if (abs(data[:, 1][line] - star_velocity(speed_star,
-                                                 angular_speed,
-                                                 phase,
-                                                 data[:, 0][line])) >
-                (number_of_standard_deviations * standard_deviation)):
-            rows_with_errors.append(line)
-    data_second_cleaning = np.delete(data, rows_with_errors, 0)
-    if rows_with_errors == []:
-        print('No data was removed')
+    number_of_points = int(min(maximum_points,
+                               max(1, maximum_angular_speed / step)))
 
-    return data_second_cleaning
+    return step * np.arange(1, number_of_points + 1)
 
 
-def plot_raw_data(data, name_of_saved_file):
+def lomb_scargle_periodogram(data, angular_speeds,
+                             chunk_elements=CHI_SQUARED_CHUNK_ELEMENTS):
     """
-    Plots the raw data. Allows the user to choose a name for the saved plot.
+    Returns the generalised Lomb-Scargle periodogram (Zechmeister & Kurster
+    2009) of the star velocity, which fits a weighted sinusoid plus a
+    constant at every angular speed. The power is the fraction of the
+    weighted variance removed by the fit, between 0 and 1. The sums are
+    accumulated over blocks of angular speeds and data points so no
+    temporary array is larger than chunk_elements.
 
     Parameters
     ----------
-    data : numpy array of floats
-    name_of_saved_file : string
+    data : list
+        [time, star velocity, uncertainty]
+    angular_speeds : numpy array
+        rad / second
+    chunk_elements : int
+        The default is CHI_SQUARED_CHUNK_ELEMENTS.
 
     Returns
     -------
-    plt.show()
-        shows the plot of the data
+    power : numpy array
 
     """
-    raw_data_figure = plt.figure(figsize=(10, 4))
-    raw_data_plot = raw_data_figure.add_subplot(111)
-    raw_data_plot.set_title('Raw data - wavelenght against time',
-                            fontname='Times New Roman', fontsize=20)
-    raw_data_plot.set_xlabel('Time (years)', fontname='Times New Roman',
-                             fontsize=15)
-    raw_data_plot.set_ylabel('Wavelenght (nm)', fontname='Times New Roman',
-                             fontsize=15)
-    raw_data_plot.errorbar(data[:, 0], data[:, 1],
-                           yerr=data[:, 2], fmt='o',
+    time, velocity, uncertainty = (np.asarray(data[0]), np.asarray(data[1]),
+                                   np.asarray(data[2]))
+    angular_speeds = np.asarray(angular_speeds, dtype=float)
+    profile_count('lomb_scargle_periodogram', angular_speeds.size)
+    weights = 1 / uncertainty**2
+    weights = weights / np.sum(weights)
+    weighted_velocity = weights * velocity
+
+    # columns: cos, sin, y cos, y sin, cos^2, sin cos
+    sums = np.zeros((len(angular_speeds), 6))
+    speeds_per_chunk, rows_per_chunk = chunk_shape(
+        len(angular_speeds), len(time), chunk_elements)
+
+    for speed_start in range(0, len(angular_speeds), speeds_per_chunk):
+        speeds = slice(speed_start, speed_start + speeds_per_chunk)
+        for row_start in range(0, len(time), rows_per_chunk):
+            rows = slice(row_start, row_start + rows_per_chunk)
+            argument = angular_speeds[speeds, np.newaxis] * time[rows]
+            cosine = np.cos(argument)
+            sine = np.sin(argument)
+            sums[speeds] += np.column_stack((
+                cosine @ weights[rows], sine @ weights[rows],
+                cosine @ weighted_velocity[rows],
+                sine @ weighted_velocity[rows],
+                cosine**2 @ weights[rows],
+                (sine * cosine) @ weights[rows]))
+
+    cos_sum, sin_sum, velocity_cos, velocity_sin, cos_squared, sin_cos = \
+        sums.T
+    mean_velocity = np.sum(weighted_velocity)
+    velocity_variance = np.sum(weighted_velocity * velocity) - \
+        mean_velocity**2
+    velocity_cos = velocity_cos - mean_velocity * cos_sum
+    velocity_sin = velocity_sin - mean_velocity * sin_sum
+    cos_variance = cos_squared - cos_sum**2
+    sin_variance = (1 - cos_squared) - sin_sum**2
+    covariance = sin_cos - cos_sum * sin_sum
+    determinant = cos_variance * sin_variance - covariance**2
+
+    return ((sin_variance * velocity_cos**2 + cos_variance * velocity_sin**2 -
+             2 * covariance * velocity_cos * velocity_sin) /
+            (velocity_variance * determinant))
+
+
+def periodogram_peaks(angular_speeds, power,
+                      number_of_peaks=PERIODOGRAM_PEAKS):
+    """
+    Returns the angular speeds of the highest local maxima of a periodogram,
+    highest first.
+
+    Parameters
+    ----------
+    angular_speeds : numpy array
+        rad / second
+    power : numpy array
+    number_of_peaks : int
+        The default is PERIODOGRAM_PEAKS.
+
+    Returns
+    -------
+    peaks : numpy array
+        rad / second
+
+    """
+    padded = np.concatenate(([-np.inf], power, [-np.inf]))
+    is_peak = (padded[1:-1] >= padded[:-2]) & (padded[1:-1] > padded[2:])
+    peak_index = np.flatnonzero(is_peak)
+    peak_index = peak_index[np.argsort(power[peak_index])[::-1]]
+
+    return angular_speeds[peak_index[:number_of_peaks]]
+
+
+def periodogram_fit(data, number_of_peaks=PERIODOGRAM_PEAKS,
+                    angular_speeds=None):
+    """
+    Finds starting angular speeds from the highest peaks of the Lomb-Scargle
+    periodogram, runs separable_fit from each and returns the fit with the
+    smallest chi squared. No hand-tuned start values are needed.
+
+    Parameters
+    ----------
+    data : list
+        [time, star velocity, uncertainty]
+    number_of_peaks : int
+        The default is PERIODOGRAM_PEAKS.
+    angular_speeds : numpy array
+        rad / second. The default is None, which uses angular_speed_grid.
+
+    Returns
+    -------
+    fit : tuple
+        in the same layout as separable_fit
+
+    """
+    if angular_speeds is None:
+        angular_speeds = angular_speed_grid(data[0])
+
+    power = lomb_scargle_periodogram(data, angular_speeds)
+    fits = [separable_fit(data, peak) for peak in
+            periodogram_peaks(angular_speeds, power, number_of_peaks)]
+
+    return min(fits, key=lambda fit: fit[1])
+
+
+def sigma_clip_mask(values, number_of_standard_deviations, centre=None,
+                    scale=None, max_iterations=SIGMA_CLIP_MAX_ITERATIONS,
+                    ddof=0, mask=None):
+    """
+    Returns a boolean mask of the values to keep after iterative sigma
+    clipping. On each pass values more than number_of_standard_deviations
+    standard deviations from the centre are dropped, with the mean and
+    standard deviation found from the values still kept. Clipping stops when
+    a pass drops nothing or after max_iterations passes. The data are never
+    copied; each pass is linear in the number of values.
+
+    Parameters
+    ----------
+    values : numpy array of floats
+    number_of_standard_deviations : float
+        sets the tolerance
+    centre : float
+        The default is None, which uses the mean of the kept values.
+    scale : float
+        The default is None, which uses the standard deviation of the kept
+        values.
+    max_iterations : int
+        The default is SIGMA_CLIP_MAX_ITERATIONS. Use 1 for a single pass.
+    ddof : int
+        delta degrees of freedom of the standard deviation. The default is 0.
+    mask : numpy array of bools
+        values already excluded are False. The default is None.
+
+    Returns
+    -------
+    keep : numpy array of bools
+
+    """
+    keep = (np.ones(np.shape(values), dtype=bool) if mask is None
+            else np.array(mask, dtype=bool))
+
+    for dummy in range(max_iterations):
+        number_kept = np.count_nonzero(keep)
+        if number_kept <= ddof:
+            break
+        middle = np.mean(values, where=keep) if centre is None else centre
+        spread = (np.std(values, where=keep, ddof=ddof) if scale is None
+                  else scale)
+        keep &= np.abs(values - middle) <= (number_of_standard_deviations *
+                                            spread)
+        if np.count_nonzero(keep) == number_kept:
+            break
+
+    return keep
+
+
+def model_residual_mask(data, number_of_standard_deviations, speed_star,
+                        angular_speed, phase, scale=None,
+                        max_iterations=SIGMA_CLIP_MAX_ITERATIONS, mask=None):
+    """
+    Returns a boolean mask of the data points to keep after sigma clipping
+    their residuals from the star velocity model.
+
+    Parameters
+    ----------
+    data : numpy array of floats
+        rows of [time, star velocity, uncertainty]
+    number_of_standard_deviations : float
+        sets the tolerance
+    speed_star : numpy float64
+    angular_speed : numpy float64
+    phase : numpy float64
+    scale : float
+        The default is None, which uses the standard deviation of the kept
+        residuals.
+    max_iterations : int
+        The default is SIGMA_CLIP_MAX_ITERATIONS.
+    mask : numpy array of bools
+        The default is None.
+
+    Returns
+    -------
+    keep : numpy array of bools
+
+    """
+    residuals = data[:, 1] - star_velocity(speed_star, angular_speed, phase,
+                                           data[:, 0])
+
+    return sigma_clip_mask(residuals, number_of_standard_deviations,
+                           centre=0, scale=scale,
+                           max_iterations=max_iterations, mask=mask)
+
+
+def remove_outliers_1(data, number_of_standard_deviations,
+                      max_iterations=OUTLIER_CLIP_ITERATIONS):
+    """
+    Removes outliers from some data set that are more than a number of standard
+    deviations away from the mean.
+
+    Parameters
+    ----------
+    data : numpy array of floats
+    number_of_standard_deviations : int
+        sets the tolerance
+    max_iterations : int
+        The default is OUTLIER_CLIP_ITERATIONS, a single pass.
+
+    Returns
+    -------
+    data_first_cleaning : numpy array
+
+    """
+    return data[sigma_clip_mask(data[:, 1], number_of_standard_deviations,
+                                max_iterations=max_iterations)]
+
+
+def remove_outliers_2(data, number_of_standard_deviations,
+                      speed_star, angular_speed, phase, verbose=False,
+                      max_iterations=OUTLIER_CLIP_ITERATIONS):
+    """
+    Removes data points that are far away from the line of best fit. This must
+    be run after points that are far away from the mean are removed. With
+    verbose it says so when no data was removed.
+
+    Parameters
+    ----------
+    data : numpy array of floats
+    number_of_standard_deviations : int
+        sets the tolerance
+    speed_star : numpy float64
+    angular_speed : numpy float64
+    phase : numpy float64
+    verbose : bool
+        The default is False.
+    max_iterations : int
+        The default is OUTLIER_CLIP_ITERATIONS, a single pass.
+
+    Returns
+    -------
+    data_second_cleaning : numpy array
+
+    """
+    keep = model_residual_mask(data, number_of_standard_deviations,
+                               speed_star, angular_speed, phase,
+                               scale=np.std(data[:, 1], ddof=1),
+                               max_iterations=max_iterations)
+    if verbose and keep.all():
+        print('No data was removed')
+
+    return data[keep]
+
+
+def pyplot():
+    """
+    Imports matplotlib.pyplot on first use. Unless pyplot is already loaded or
+    MPLBACKEND chooses a backend, the non-interactive Agg backend is used, so
+    plots are only saved to file.
+
+    Returns
+    -------
+    matplotlib.pyplot
+
+    """
+    if 'matplotlib.pyplot' not in sys.modules and (
+            'MPLBACKEND' not in os.environ):
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def plot_raw_data(data, name_of_saved_file):
+    """
+    Plots the raw data. Allows the user to choose a name for the saved plot.
+
+    Parameters
+    ----------
+    data : numpy array of floats
+    name_of_saved_file : string
+
+    Returns
+    -------
+    plt.show()
+        shows the plot of the data
+
+    """
+    import matplotlib.ticker as mtick
+    plt = pyplot()
+
+    raw_data_figure = plt.figure(figsize=(10, 4))
+    raw_data_plot = raw_data_figure.add_subplot(111)
+    raw_data_plot.set_title('Raw data - wavelenght against time',
+                            fontname='Times New Roman', fontsize=20)
+    raw_data_plot.set_xlabel('Time (years)', fontname='Times New Roman',
+                             fontsize=15)
+    raw_data_plot.set_ylabel('Wavelenght (nm)', fontname='Times New Roman',
+                             fontsize=15)
+    raw_data_plot.errorbar(data[:, 0], data[:, 1],
+                           yerr=data[:, 2], fmt='o',
                            label='Raw data points')
     raw_data_plot.yaxis.\
         set_major_formatter(mtick.FormatStrFormatter('%.7e'))
@@ -352,7 +1345,9 @@ def plot_raw_data(data, name_of_saved_file):
         set_major_formatter(mtick.FormatStrFormatter('%.1f'))
     plt.legend(loc=4)
     plt.tight_layout()
+    profile_lap('plot_raw_data', number_of_points=len(data))
     plt.savefig(name_of_saved_file, dpi=300)
+    profile_lap('savefig ' + name_of_saved_file)
     return plt.show()
 
 
@@ -377,6 +1372,9 @@ def plot_fitted_data(name_of_saved_file, fitted_parameters,
         shows the plot of the data
 
     """
+    import matplotlib.ticker as mtick
+    plt = pyplot()
+
     fitted_data_figure = plt.figure(figsize=(11, 4))
     fitted_data_plot = fitted_data_figure.add_subplot(111)
 
@@ -412,11 +1410,13 @@ def plot_fitted_data(name_of_saved_file, fitted_parameters,
         set_major_formatter(mtick.FormatStrFormatter('%.2e'))
     plt.legend(loc=4)
     plt.tight_layout()
+    profile_lap('plot_fitted_data', number_of_points=len(data))
     plt.savefig(name_of_saved_file, dpi=450)
+    profile_lap('savefig ' + name_of_saved_file)
     return plt.show()
 
 
-def chi_squared_calculator(prediction, data, uncertainty):
+def chi_squared_calculator(prediction, data, uncertainty, axis=None):
     """
     Returns chi squared.
 
@@ -425,12 +1425,77 @@ def chi_squared_calculator(prediction, data, uncertainty):
     prediction : numpy array
     data : numpy array 
     uncertainty : numpy array 
+    axis : int
+        axis summed over, so a stack of predictions gives one chi squared
+        each. The default is None, which sums everything.
 
     Returns
     -------
     chi_squared : float
     """
-    chi_squared = np.sum(((prediction - data) / uncertainty)**2)
+    chi_squared = np.sum(((prediction - data) / uncertainty)**2, axis=axis)
+    profile_count('chi_squared_calculator', np.size(chi_squared))
+    return chi_squared
+
+
+def chi_squared_out_of_core(parameters, data, phase=None,
+                            block_size=OUT_OF_CORE_BLOCK_ROWS,
+                            gradient=False):
+    """
+    Accumulates the chi squared of the star velocity, and optionally its
+    gradient, over blocks of block_size rows, so only one block of the data
+    is in memory at a time. The columns can be numpy memmaps. When the data
+    fits in one block the result is bit for bit the in-memory
+    chi_squared_calculator(star_velocity(...)).
+
+    Parameters
+    ----------
+    parameters : numpy array
+        [speed_star, angular_speed], or [speed_star, angular_speed, phase]
+        when phase is None
+    data : list
+        [time, star velocity, uncertainty] columns
+    phase : float
+        rad. The default is None.
+    block_size : int
+        The default is OUT_OF_CORE_BLOCK_ROWS.
+    gradient : bool
+        The default is False.
+
+    Returns
+    -------
+    chi_squared : float
+    chi_squared_gradient : numpy array
+        only when gradient is True, d chi^2 / d parameters
+
+    """
+    speed_star, angular_speed = parameters[0], parameters[1]
+    fitted_phase = phase is None
+    if fitted_phase:
+        phase = parameters[2]
+
+    chi_squared = 0.
+    chi_squared_gradient = np.zeros(3)
+    for start in range(0, len(data[0]), block_size):
+        rows = slice(start, start + block_size)
+        time = np.asarray(data[0][rows])
+        velocity = np.asarray(data[1][rows])
+        uncertainty = np.asarray(data[2][rows])
+        prediction = star_velocity(speed_star, angular_speed, phase, time)
+        chi_squared += chi_squared_calculator(prediction, velocity,
+                                              uncertainty)
+
+        if gradient:
+            weighted_residuals = 2 * (prediction - velocity) / uncertainty**2
+            sine = np.sin(angular_speed * time + phase)
+            cosine = np.cos(angular_speed * time + phase)
+            chi_squared_gradient += np.array([
+                np.sum(weighted_residuals * sine),
+                speed_star * np.sum(weighted_residuals * time * cosine),
+                speed_star * np.sum(weighted_residuals * cosine)])
+
+    if gradient:
+        return chi_squared, chi_squared_gradient[:3 if fitted_phase else 2]
     return chi_squared
 
 
@@ -454,12 +1519,106 @@ def chi_squared_for_plot(a_parameter, b_parameter, data, phase):
     chi_square : numpy array
 
     """
-    chi_square = 0
-    for entry in data:
-        chi_square += (((star_velocity(a_parameter, b_parameter, phase,
-                                       entry[0])
-                         - entry[1]) / entry[2])**2)
-    return chi_square
+    return chi_squared_surface(a_parameter, b_parameter, data, phase)
+
+
+def chunk_shape(number_of_columns, number_of_rows,
+                chunk_elements=CHI_SQUARED_CHUNK_ELEMENTS):
+    """
+    Returns the block shape used to broadcast number_of_columns parameter
+    values against number_of_rows data points with no temporary array larger
+    than chunk_elements. The block is square unless one side is shorter, in
+    which case the other side takes the rest, so neither loop falls back to
+    one row or one column at a time.
+
+    Parameters
+    ----------
+    number_of_columns : int
+    number_of_rows : int
+    chunk_elements : int
+        The default is CHI_SQUARED_CHUNK_ELEMENTS.
+
+    Returns
+    -------
+    columns_per_chunk : int
+    rows_per_chunk : int
+
+    """
+    side = max(1, int(np.sqrt(chunk_elements)))
+    columns_per_chunk = max(1, min(number_of_columns,
+                                   max(side, chunk_elements //
+                                       max(1, number_of_rows))))
+    rows_per_chunk = max(1, chunk_elements // columns_per_chunk)
+
+    return columns_per_chunk, rows_per_chunk
+
+
+def chi_squared_surface(speed_star, angular_speed, data, phase,
+                        chunk_elements=CHI_SQUARED_CHUNK_ELEMENTS):
+    """
+    Returns the chi squared of the star velocity for every pair of speed_star
+    and angular_speed values, which can be arrays of any shape that broadcast
+    together, e.g. a mesh.
+
+    For a fixed angular speed the chi squared is quadratic in the speed of
+    the star,
+        chi^2 = A v0^2 - 2 B v0 + C,
+    with A = sum(s^2 / sigma^2), B = sum(s v / sigma^2), C = sum(v^2 / sigma^2)
+    and s = sin(w t + phase). The sums are found once for each distinct
+    angular speed, by broadcasting against blocks of data points so no
+    temporary array is larger than chunk_elements, and the whole surface is
+    then built from them.
+
+    Parameters
+    ----------
+    speed_star : numpy array
+        meters / second
+    angular_speed : numpy array
+        rad / second
+    data : numpy array
+        rows of [time, star velocity, uncertainty]
+    phase : float
+        rad
+    chunk_elements : int
+        The default is CHI_SQUARED_CHUNK_ELEMENTS.
+
+    Returns
+    -------
+    chi_squared : numpy array
+        same shape as the broadcast parameters
+
+    """
+    speed_star, angular_speed = np.broadcast_arrays(
+        np.asarray(speed_star, dtype=float),
+        np.asarray(angular_speed, dtype=float))
+    data = np.asarray(data, dtype=float)
+    profile_count('chi_squared_surface', speed_star.size)
+
+    unique_angular_speed, inverse = np.unique(angular_speed,
+                                              return_inverse=True)
+    weights = 1 / data[:, 2]**2
+    weighted_velocity = data[:, 1] * weights
+
+    sum_sine_squared = np.zeros(len(unique_angular_speed))
+    sum_sine_velocity = np.zeros(len(unique_angular_speed))
+    speeds_per_chunk, rows_per_chunk = chunk_shape(len(unique_angular_speed),
+                                                   len(data), chunk_elements)
+
+    for speed_start in range(0, len(unique_angular_speed), speeds_per_chunk):
+        speeds = slice(speed_start, speed_start + speeds_per_chunk)
+        for row_start in range(0, len(data), rows_per_chunk):
+            rows = slice(row_start, row_start + rows_per_chunk)
+            sine = star_velocity(1, unique_angular_speed[speeds, np.newaxis],
+                                 phase, data[rows, 0])
+            sum_sine_squared[speeds] += (sine**2) @ weights[rows]
+            sum_sine_velocity[speeds] += sine @ weighted_velocity[rows]
+
+    sum_velocity_squared = np.sum(data[:, 1] * weighted_velocity)
+    inverse = inverse.reshape(angular_speed.shape)
+
+    return (sum_sine_squared[inverse] * speed_star**2 -
+            2 * sum_sine_velocity[inverse] * speed_star +
+            sum_velocity_squared)
 
 
 def mesh_arrays(x_array, y_array):
@@ -477,27 +1636,249 @@ def mesh_arrays(x_array, y_array):
     y_array_mesh : numpy array
 
     """
+    return np.meshgrid(x_array, y_array)
 
-    x_array_mesh = np.empty((0, len(x_array)))
 
-    for dummy in range(len(y_array)):
-        x_array_mesh = np.vstack((x_array_mesh, x_array))
+def chi_squared_landscape(fitted_parameters, data, phase,
+                          x_shift=X_VALUES_SHIFT_CONTOUR_PLOT,
+                          y_shift=Y_VALUES_SHIFT_CONTOUR_PLOT,
+                          number_of_points=NUMBER_OF_POINTS_CONTOUR_PLOT):
+    """
+    Evaluates the chi squared once on a grid of speed of star and angular
+    speed values centred on the fitted parameters.
 
-    y_array_mesh = np.empty((0, len(y_array)))
+    Parameters
+    ----------
+    fitted_parameters : numpy array
+    data : numpy array
+    phase : float
+        rad
+    x_shift : float
+        half width of the grid in speed of star. The default is
+        X_VALUES_SHIFT_CONTOUR_PLOT.
+    y_shift : float
+        half width of the grid in angular speed. The default is
+        Y_VALUES_SHIFT_CONTOUR_PLOT.
+    number_of_points : int
+        The default is NUMBER_OF_POINTS_CONTOUR_PLOT.
 
-    for dummy in range(len(x_array)):
-        y_array_mesh = np.vstack((y_array_mesh, y_array))
+    Returns
+    -------
+    x_mesh : numpy array
+    y_mesh : numpy array
+    chi_squared : numpy array
 
-    y_array_mesh = np.transpose(y_array_mesh)
+    """
+    x_values = np.linspace(fitted_parameters[0] - x_shift,
+                           fitted_parameters[0] + x_shift,
+                           number_of_points)
+    y_values = np.linspace(fitted_parameters[1] - y_shift,
+                           fitted_parameters[1] + y_shift,
+                           number_of_points)
+
+    x_mesh, y_mesh = mesh_arrays(x_values, y_values)
 
-    return x_array_mesh, y_array_mesh
+    return x_mesh, y_mesh, chi_squared_surface(x_mesh, y_mesh, data, phase)
+
+
+def contour_window(fitted_parameters, data, phase, level, x_shift, y_shift,
+                   number_of_cells=CONTOUR_BASE_CELLS):
+    """
+    Grows a window centred on the fitted parameters until the chi squared is
+    above level everywhere on its edge, so the level contour is enclosed.
+    Each half width is doubled only while that pair of edges dips below
+    level.
+
+    Parameters
+    ----------
+    fitted_parameters : numpy array
+    data : numpy array
+    phase : float
+        rad
+    level : float
+    x_shift : float
+        starting half width in speed of star
+    y_shift : float
+        starting half width in angular speed
+    number_of_cells : int
+        points checked along each edge. The default is CONTOUR_BASE_CELLS.
+
+    Returns
+    -------
+    x_shift : float
+    y_shift : float
+    evaluations : int
+
+    """
+    evaluations = 0
+    for dummy in range(CONTOUR_WINDOW_MAX_GROWTH):
+        edge = np.linspace(-1, 1, number_of_cells + 1)
+        sides = np.array([-1, 1])[:, np.newaxis]
+        vertical_edges = chi_squared_surface(
+            fitted_parameters[0] + x_shift * sides,
+            fitted_parameters[1] + y_shift * edge, data, phase)
+        horizontal_edges = chi_squared_surface(
+            fitted_parameters[0] + x_shift * edge,
+            fitted_parameters[1] + y_shift * sides, data, phase)
+        evaluations += vertical_edges.size + horizontal_edges.size
+
+        grow_x = np.min(vertical_edges) < level
+        grow_y = np.min(horizontal_edges) < level
+        if not (grow_x or grow_y):
+            return x_shift, y_shift, evaluations
+        x_shift *= 2 if grow_x else 1
+        y_shift *= 2 if grow_y else 1
+
+    raise ValueError('chi squared contour is not closed')
+
+
+def adaptive_contours(fitted_parameters, data, phase, minimum_chi_squared,
+                      offsets=CONTOUR_OFFSETS, x_shift=None, y_shift=None,
+                      number_of_cells=CONTOUR_BASE_CELLS,
+                      depth=CONTOUR_REFINEMENT_DEPTH):
+    """
+    Finds the contours of the chi squared at minimum_chi_squared + offsets in
+    speed of star and angular speed, with the phase fixed. The window is
+    grown with contour_window until every level is enclosed. A coarse grid of
+    cells is then halved quadtree-style, only where a level passes between
+    the corner values of a cell, and the contours are traced through the
+    finest cells by linear interpolation along their edges. The resolution
+    matches a grid of number_of_cells * 2**depth points per side.
+
+    Parameters
+    ----------
+    fitted_parameters : numpy array
+    data : numpy array
+    phase : float
+        rad
+    minimum_chi_squared : float
+    offsets : tuple of floats
+        The default is CONTOUR_OFFSETS.
+    x_shift : float
+        starting half width in speed of star. The default is None, which
+        takes it from the curvature at the minimum.
+    y_shift : float
+        starting half width in angular speed. The default is None, which
+        takes it from the curvature at the minimum.
+    number_of_cells : int
+        The default is CONTOUR_BASE_CELLS.
+    depth : int
+        The default is CONTOUR_REFINEMENT_DEPTH.
+
+    Returns
+    -------
+    contours : dict
+        offset: numpy array of line segments, shape (segments, 2, 2), in
+        (speed of star, angular speed)
+    evaluations : int
+        number of chi squared evaluations
+
+    """
+    levels = minimum_chi_squared + np.asarray(offsets, dtype=float)
+    if x_shift is None or y_shift is None:
+        hessian = chi_squared_derivatives(fitted_parameters[0],
+                                          fitted_parameters[1], data,
+                                          phase)[2]
+        shifts = CONTOUR_WINDOW_MARGIN * np.sqrt(
+            np.abs(2 * np.max(offsets) * np.diag(np.linalg.inv(hessian))))
+        x_shift = shifts[0] if x_shift is None else x_shift
+        y_shift = shifts[1] if y_shift is None else y_shift
+    x_shift, y_shift, evaluations = contour_window(
+        fitted_parameters, data, phase, np.max(levels), x_shift, y_shift,
+        number_of_cells)
+
+    # Corners live on an integer lattice of the finest resolution, so values
+    # shared between cells and between depths are evaluated only once.
+    lattice_points = number_of_cells * 2**depth + 1
+    x_step = 2 * x_shift / (lattice_points - 1)
+    y_step = 2 * y_shift / (lattice_points - 1)
+    keys = np.empty(0, dtype=np.int64)
+    values = np.empty(0)
+
+    size = 2**depth
+    i_index, j_index = np.meshgrid(np.arange(number_of_cells) * size,
+                                   np.arange(number_of_cells) * size)
+    i_index, j_index = i_index.ravel(), j_index.ravel()
+    offsets_i = np.array([0, 1, 1, 0])
+    offsets_j = np.array([0, 0, 1, 1])
+
+    while True:
+        corner_i = i_index[:, np.newaxis] + offsets_i * size
+        corner_j = j_index[:, np.newaxis] + offsets_j * size
+        corner_keys = corner_i * lattice_points + corner_j
+
+        new_keys = np.setdiff1d(corner_keys, keys)
+        new_values = chi_squared_surface(
+            fitted_parameters[0] - x_shift + (new_keys // lattice_points) *
+            x_step,
+            fitted_parameters[1] - y_shift + (new_keys % lattice_points) *
+            y_step, data, phase)
+        evaluations += new_keys.size
+        keys = np.concatenate((keys, new_keys))
+        values = np.concatenate((values, new_values))
+        order = np.argsort(keys)
+        keys, values = keys[order], values[order]
+        corner_values = values[np.searchsorted(keys, corner_keys)]
+
+        lowest = np.min(corner_values, axis=1)[:, np.newaxis]
+        highest = np.max(corner_values, axis=1)[:, np.newaxis]
+        crossing = np.any((lowest < levels) & (highest >= levels), axis=1)
+        i_index, j_index = i_index[crossing], j_index[crossing]
+        if size == 1:
+            corner_i, corner_j = corner_i[crossing], corner_j[crossing]
+            corner_values = corner_values[crossing]
+            break
+        size //= 2
+        i_index = (i_index[:, np.newaxis] + offsets_i * size).ravel()
+        j_index = (j_index[:, np.newaxis] + offsets_j * size).ravel()
+
+    # Marching squares: every cell edge whose ends straddle a level holds
+    # one contour point, and a cell always holds 0, 2 or 4 of them.
+    points = np.stack((fitted_parameters[0] - x_shift + corner_i * x_step,
+                       fitted_parameters[1] - y_shift + corner_j * y_step),
+                      axis=-1)
+    next_corner = np.roll(np.arange(4), -1)
+    contours = {}
+    for offset, level in zip(offsets, levels):
+        start, end = corner_values, corner_values[:, next_corner]
+        straddles = (start < level) != (end < level)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = ((level - start) / (end - start))[..., np.newaxis]
+        edge_points = points + fraction * (points[:, next_corner] - points)
+        contours[offset] = edge_points[straddles].reshape(-1, 2, 2)
+
+    return contours, evaluations
+
+
+def uncertainty_from_contour(segments):
+    """
+    Calculates the uncertainty of the fitted variables as half the extent of
+    a contour.
+
+    Parameters
+    ----------
+    segments : numpy array
+        contour line segments from adaptive_contours
+
+    Returns
+    -------
+    speed_star_uncertaintys : numpy float64
+        meters / second
+    angular_speed_uncertaintys : numpy float64
+        rad / s
+
+    """
+    vertices = segments.reshape(-1, 2)
+    return np.ptp(vertices[:, 0]) / 2, np.ptp(vertices[:, 1]) / 2
 
 
 def contour_plot_function(fitted_parameters, data, minimum_chi_squared, phase):
     """
     Generates a contour plot of the minimum chi squared along with the minimum
     chi squared +1, +2.3, +5.99, +9.21. The minimum chi squared +1 is also
-    produced seperately saved in the same file.
+    produced seperately saved in the same file, titled with the uncertainties
+    read from it by uncertainty_from_contour. The contours come from
+    adaptive_contours.
 
     Parameters
     ----------
@@ -513,155 +1894,257 @@ def contour_plot_function(fitted_parameters, data, minimum_chi_squared, phase):
         shows the plot of the data
     parameters_contour_plot : numpy array
     """
+    import matplotlib.ticker as mtick
+    from matplotlib.collections import LineCollection
+    plt = pyplot()
 
-    x_values = np.linspace(fitted_parameters[0] - X_VALUES_SHIFT_CONTOUR_PLOT,
-                           fitted_parameters[0] + X_VALUES_SHIFT_CONTOUR_PLOT,
-                           NUMBER_OF_POINTS_CONTOUR_PLOT)
-    y_values = np.linspace(fitted_parameters[1] - Y_VALUES_SHIFT_CONTOUR_PLOT,
-                           fitted_parameters[1] + Y_VALUES_SHIFT_CONTOUR_PLOT,
-                           NUMBER_OF_POINTS_CONTOUR_PLOT)
-
-    x_mesh, y_mesh = mesh_arrays(x_values, y_values)
-
-    parameters_contour_figure = plt.figure(figsize=(7.9, 7.2))
-
-    parameters_contour_plot = parameters_contour_figure.add_subplot(212)
-
-    parameters_contour_plot.set_title(r'$\chi^2$ contours against parameters.',
-                                      fontsize=14)
-    parameters_contour_plot.set_xlabel(('Magnitude of star velocity / $v_0$'
-                                        ' (m/s)'), fontsize=14)
-    parameters_contour_plot.set_ylabel(r'Angular speed / $\omega$ (rad/s)',
-                                       fontsize=14)
-    parameters_contour_plot.yaxis.set_major_formatter(mtick.
-                                                      FormatStrFormatter
-                                                      ('%.3e'))
-
-    parameters_contour_plot.scatter(fitted_parameters[0], fitted_parameters[1],
-                                    label='Minimum')
-
-    parameters_contour_plot.\
-        contour(x_mesh,
-                y_mesh,
-                chi_squared_for_plot(x_mesh,
-                                     y_mesh,
-                                     data, phase),
-                levels=[minimum_chi_squared + MINIMUM_CHI_SQUARED_OFFSET_1],
-                linestyles='dashed',
-                colors='k')
-
-    chi_squared_levels = (minimum_chi_squared + MINIMUM_CHI_SQUARED_OFFSET_2,
-                          minimum_chi_squared + MINIMUM_CHI_SQUARED_OFFSET_3,
-                          minimum_chi_squared + MINIMUM_CHI_SQUARED_OFFSET_4)
-
-    contour_plot = parameters_contour_plot.\
-        contour(x_mesh,
-                y_mesh,
-                chi_squared_for_plot(x_mesh,
-                                     y_mesh,
-                                     data, phase),
-                levels=chi_squared_levels)
-    labels = ['Minimum', r'$\chi^2_{{\mathrm{{min.}}}}+1.00$',
+    contours = adaptive_contours(fitted_parameters, data, phase,
+                                 minimum_chi_squared)[0]
+    labels = [r'$\chi^2_{{\mathrm{{min.}}}}+1.00$',
               r'$\chi^2_{{\mathrm{{min.}}}}+2.30$',
               r'$\chi^2_{{\mathrm{{min.}}}}+5.99$',
               r'$\chi^2_{{\mathrm{{min.}}}}+9.21$']
+    colours = ['k'] + list(plt.cm.viridis(np.linspace(0, 1,
+                                                      len(CONTOUR_OFFSETS) -
+                                                      1)))
 
-    parameters_contour_plot.clabel(contour_plot)
+    parameters_contour_figure = plt.figure(figsize=(7.9, 7.2))
 
-    box = parameters_contour_plot.get_position()
-    parameters_contour_plot.set_position([box.x0, box.y0, box.width,
-                                          box.height])
+    # The minimum chi squared +1 alone on top, all of the contours below
+    for subplot, offsets in ((212, CONTOUR_OFFSETS),
+                             (211, CONTOUR_OFFSETS[:1])):
+        parameters_contour_plot = parameters_contour_figure.add_subplot(
+            subplot)
+
+        if subplot == 212:
+            parameters_contour_plot.set_title(
+                r'$\chi^2$ contours against parameters.', fontsize=14)
+        else:
+            parameters_contour_plot.set_title(
+                (r'$\chi^2 + 1$ contour against parameters.' '\n'
+                 r'$\Delta v_0$ = {0:.2f} m/s, '
+                 r'$\Delta \omega$ = {1:.2e} rad/s').format(
+                     *uncertainty_from_contour(contours[offsets[0]])),
+                fontsize=14)
+        parameters_contour_plot.set_xlabel(('Magnitude of star velocity'
+                                            ' / $v_0$ (m/s)'), fontsize=14)
+        parameters_contour_plot.set_ylabel(
+            r'Angular speed / $\omega$ (rad/s)', fontsize=14)
+        parameters_contour_plot.yaxis.set_major_formatter(mtick.
+                                                          FormatStrFormatter
+                                                          ('%.3e'))
+
+        parameters_contour_plot.scatter(fitted_parameters[0],
+                                        fitted_parameters[1],
+                                        label='Minimum')
 
-    for index, label in enumerate(labels):
-        parameters_contour_plot.collections[index].set_label(label)
-    parameters_contour_plot.legend(loc='center left', bbox_to_anchor=(1, 0.5),
-                                   fontsize=14)
+        for index, offset in enumerate(offsets):
+            parameters_contour_plot.add_collection(
+                LineCollection(contours[offset], colors=[colours[index]],
+                               label=labels[index]))
+        parameters_contour_plot.autoscale_view()
 
-    # Chi squared plot for minimum chi squared + 1
+        if subplot == 212:
+            parameters_contour_plot.legend(loc='center left',
+                                           bbox_to_anchor=(1, 0.5),
+                                           fontsize=14)
 
-    parameters_contour_plot = parameters_contour_figure.add_subplot(211)
+    plt.tight_layout()
+    profile_lap('contour_plot_function', number_of_points=len(data))
+    plt.savefig('contour_plot.png', dpi=300)
+    profile_lap('savefig contour_plot.png')
 
-    parameters_contour_plot.set_title(
-        r'$\chi^2 + 1$ contour against parameters.',
-        fontsize=14)
-    parameters_contour_plot.set_xlabel(('Magnitude of star velocity'
-                                        '/ $v_0$ (m/s)'), fontsize=14)
-    parameters_contour_plot.set_ylabel((r'Angular speed/ $\omega$ (rad/s)'),
-                                       fontsize=14)
-    parameters_contour_plot.yaxis.set_major_formatter(mtick.
-                                                      FormatStrFormatter
-                                                      ('%.3e'))
+    return plt.show(), parameters_contour_plot
 
-    parameters_contour_plot.scatter(fitted_parameters[0], fitted_parameters[1],
-                                    label='Minimum')
 
-    parameters_contour_plot.\
-        contour(x_mesh,
-                y_mesh,
-                chi_squared_for_plot(x_mesh,
-                                     y_mesh,
-                                     data, phase),
-                levels=[minimum_chi_squared + MINIMUM_CHI_SQUARED_OFFSET_1],
-                linestyles='dashed',
-                colors='k')
+def chi_squared_derivatives(speed_star, angular_speed, data, phase):
+    """
+    Calculates the chi squared and its exact gradient and Hessian with
+    respect to the speed of star and angular speed, with the phase fixed.
 
-    parameters_contour_plot.clabel(contour_plot)
+    Parameters
+    ----------
+    speed_star : float
+        meters / second
+    angular_speed : float
+        rad / second
+    data : numpy array
+    phase : float
+        rad
 
-    box = parameters_contour_plot.get_position()
-    parameters_contour_plot.set_position([box.x0, box.y0, box.width,
-                                          box.height])
+    Returns
+    -------
+    chi_squared : float
+    gradient : numpy array
+        [d chi^2 / dv0, d chi^2 / dw]
+    hessian : numpy array
+        2 x 2
 
-    plt.tight_layout()
-    plt.savefig('contour_plot.png', dpi=300)
+    """
+    profile_count('chi_squared_derivatives')
+    time, velocity = data[:, 0], data[:, 1]
+    weights = 1 / data[:, 2]**2
+    sine = np.sin(angular_speed * time + phase)
+    cosine = np.cos(angular_speed * time + phase)
+
+    residuals = velocity - speed_star * sine
+    derivative_speed_star = -sine
+    derivative_angular_speed = -speed_star * time * cosine
+
+    gradient = 2 * np.array([
+        np.sum(weights * residuals * derivative_speed_star),
+        np.sum(weights * residuals * derivative_angular_speed)])
+    mixed = 2 * np.sum(weights * (
+        derivative_speed_star * derivative_angular_speed -
+        residuals * time * cosine))
+    hessian = np.array([
+        [2 * np.sum(weights * sine**2), mixed],
+        [mixed, 2 * np.sum(weights * (
+            derivative_angular_speed**2 +
+            residuals * speed_star * time**2 * sine))]])
+
+    return np.sum(weights * residuals**2), gradient, hessian
+
+
+def profile_chi_squared_speed_star(speed_star, angular_speed_start, data,
+                                   phase):
+    """
+    Minimises the chi squared over the angular speed for a fixed speed of
+    star and phase, by Newton steps from angular_speed_start.
 
-    return plt.show(), parameters_contour_plot
+    Parameters
+    ----------
+    speed_star : float
+        meters / second
+    angular_speed_start : float
+        rad / second
+    data : numpy array
+    phase : float
+        rad
+
+    Returns
+    -------
+    chi_squared : float
+    angular_speed : float
+        rad / second
+
+    """
+    angular_speed = angular_speed_start
+    chi_squared, gradient, hessian = chi_squared_derivatives(
+        speed_star, angular_speed, data, phase)
+
+    for dummy in range(SEPARABLE_FIT_MAX_ITERATIONS):
+        step = -gradient[1] / hessian[1, 1] if hessian[1, 1] > 0 else\
+            -np.sign(gradient[1]) * SEPARABLE_FIT_TOLERANCE * abs(
+                angular_speed)
+
+        # Halve the step until the chi squared goes down.
+        while True:
+            trial = chi_squared_derivatives(speed_star, angular_speed + step,
+                                            data, phase)
+            if trial[0] <= chi_squared or abs(step) <= (
+                    SEPARABLE_FIT_TOLERANCE * abs(angular_speed)):
+                break
+            step /= 2
+
+        if trial[0] <= chi_squared:
+            angular_speed += step
+            chi_squared, gradient, hessian = trial
 
+        if abs(step) <= SEPARABLE_FIT_TOLERANCE * abs(angular_speed):
+            break
 
-def uncertainty_propagation(function, variable_1, variable_2,
-                            variable_1_uncertainty):
+    return chi_squared, angular_speed
+
+
+def profile_chi_squared_angular_speed(angular_speed, data, phase):
     """
-    Finds the uncertainty for the star velocity, planets distance from the
-    star, velocity of planet and the mass of the planet.
+    Minimises the chi squared over the speed of star for a fixed angular
+    speed and phase. The star velocity is linear in the speed of star, so the
+    minimum is exact.
 
     Parameters
     ----------
-    function : function
-    variable_1 : numpy float64
-    variable_2 : numpy float64
-    variable_1_uncertainty : numpy float64
+    angular_speed : float
+        rad / second
+    data : numpy array
+    phase : float
+        rad
 
     Returns
     -------
-    function uncertainty : numpy float64
+    chi_squared : float
+    speed_star : float
+        meters / second
 
     """
-    if function is star_velocity_calculator:
-        return np.abs(((SPEED_OF_LIGHT_VACUMN/EMITTED_WAVELENGHT) *
-                       variable_1_uncertainty))
+    weights = 1 / data[:, 2]**2
+    sine = np.sin(angular_speed * data[:, 0] + phase)
+    sum_sine_squared = np.sum(weights * sine**2)
+    sum_sine_velocity = np.sum(weights * sine * data[:, 1])
 
-    if function is planet_distance_from_star_calculator:
-        return np.abs((-2/3) * ((GRAVITATIONAL_CONSTANT * MASS_OF_STAR)**(1/3))
-                      * variable_1**(-5/3) *
-                      variable_1_uncertainty)
+    return (np.sum(weights * data[:, 1]**2) -
+            sum_sine_velocity**2 / sum_sine_squared,
+            sum_sine_velocity / sum_sine_squared)
 
-    if function is velocity_of_planet_calculator:
-        return np.abs(((-1/2) * (((GRAVITATIONAL_CONSTANT * MASS_OF_STAR) /
-                                  (variable_1))**(-1/2)) *
-                       ((GRAVITATIONAL_CONSTANT * MASS_OF_STAR) /
-                        (variable_1**2))) * variable_1_uncertainty)
-    return np.abs(np.sqrt((((MASS_OF_STAR * variable_1) /
-                            (variable_2)**2)**2) +
-                          ((MASS_OF_STAR/variable_2) *
-                           variable_1_uncertainty)**2))
 
+def profile_interval(profile, best_value, step, level):
+    """
+    Finds where a profile chi squared crosses level on either side of its
+    minimum at best_value. The bracket starts one step away and is doubled
+    until it encloses the crossing, which is then found by Brent's method.
 
-def uncertainty_from_contour_plot(parrameters_contour_plot):
+    Parameters
+    ----------
+    profile : function
+        profile(value) returns the profile chi squared
+    best_value : float
+    step : float
+        first guess at the distance to the crossing
+    level : float
+
+    Returns
+    -------
+    lower : float
+    upper : float
+
+    """
+    from scipy.optimize import brentq
+
+    bounds = []
+    for direction in (-1, 1):
+        inner, outer = best_value, best_value + direction * step
+        for dummy in range(PROFILE_BRACKET_MAX_ITERATIONS):
+            if profile(outer) >= level:
+                break
+            inner, outer = outer, outer + (outer - inner) * 2
+        else:
+            raise ValueError('chi squared never reaches the level')
+        bounds.append(brentq(lambda value: profile(value) - level,
+                             inner, outer, xtol=SEPARABLE_FIT_TOLERANCE *
+                             abs(best_value)))
+
+    return bounds[0], bounds[1]
+
+
+def profile_uncertainty(fitted_parameters, data, phase, minimum_chi_squared,
+                        offset=MINIMUM_CHI_SQUARED_OFFSET_1):
     """
-    Calculates the uncertainty of the fitted variables in a contour plot.
+    Finds the uncertainty of the speed of star and angular speed from the
+    boundary where the chi squared, minimised over the other parameter,
+    reaches minimum_chi_squared + offset. This is the extent of the
+    minimum chi squared + 1 contour, found without drawing it. The
+    curvature at the minimum gives the first guess at the boundary.
 
     Parameters
     ----------
-    parrameters_contour_plot : matplotlib axes_subplots AxesSubplot
+    fitted_parameters : numpy array
+    data : numpy array
+    phase : float
+        rad
+    minimum_chi_squared : float
+    offset : float
+        The default is MINIMUM_CHI_SQUARED_OFFSET_1.
 
     Returns
     -------
@@ -671,139 +2154,650 @@ def uncertainty_from_contour_plot(parrameters_contour_plot):
         rad / s
 
     """
-    axis_values_array = parrameters_contour_plot.collections[1].get_paths()[0]
-    axis_values_numpy_array = axis_values_array.vertices
-    speed_star_data = axis_values_numpy_array[:, 0]
-    angular_speed_data = axis_values_numpy_array[:, 1]
-    minimum_speed_star = np.min(speed_star_data)
-    maximum_speed_star = np.max(speed_star_data)
-    minimum_angular_speed = np.min(angular_speed_data)
-    maximum_angular_speed = np.max(angular_speed_data)
-    speed_star_uncertaintys = (maximum_speed_star -
-                               minimum_speed_star
-                               ) / 2
-    angular_speed_uncertaintys = (maximum_angular_speed -
-                                  minimum_angular_speed) / 2
+    speed_star, angular_speed = fitted_parameters[0], fitted_parameters[1]
+    level = minimum_chi_squared + offset
+    hessian = chi_squared_derivatives(speed_star, angular_speed, data,
+                                      phase)[2]
+    # Half widths of the quadratic approximation, 2 offset H^-1 = 1 sigma^2
+    steps = np.sqrt(np.abs(2 * offset * np.diag(np.linalg.inv(hessian))))
+
+    lower, upper = profile_interval(
+        lambda value: profile_chi_squared_speed_star(
+            value, angular_speed, data, phase)[0],
+        speed_star, steps[0], level)
+    speed_star_uncertaintys = (upper - lower) / 2
+    lower, upper = profile_interval(
+        lambda value: profile_chi_squared_angular_speed(
+            value, data, phase)[0],
+        angular_speed, steps[1], level)
+    angular_speed_uncertaintys = (upper - lower) / 2
 
     return speed_star_uncertaintys, angular_speed_uncertaintys
 
 
-def main():
+def log_posterior(parameters, data,
+                  chunk_elements=CHI_SQUARED_CHUNK_ELEMENTS):
     """
-    Main code for program.
+    Calculates the log posterior of a stack of [speed_star, angular_speed,
+    phase] parameters, -chi^2 / 2 with flat priors on positive speed of star
+    and angular speed. The walkers are broadcast against the data in blocks
+    from chunk_shape, so the temporary arrays stay below chunk_elements
+    however many data points there are.
+
+    Parameters
+    ----------
+    parameters : numpy array
+        shape (walkers, 3)
+    data : numpy array
+    chunk_elements : int
+        The default is CHI_SQUARED_CHUNK_ELEMENTS.
+
+    Returns
+    -------
+    log_posterior : numpy array
+        shape (walkers,)
+
     """
-    # Read in data
-    if file_check(DATA_FILE_1) and file_check(DATA_FILE_2):
+    speed_star, angular_speed, phase = np.hsplit(parameters, 3)
+    profile_count('log_posterior', len(parameters))
+
+    chi_squared = np.zeros(len(parameters))
+    walkers_per_chunk, rows_per_chunk = chunk_shape(len(parameters),
+                                                    len(data), chunk_elements)
+
+    for walker_start in range(0, len(parameters), walkers_per_chunk):
+        walkers = slice(walker_start, walker_start + walkers_per_chunk)
+        for row_start in range(0, len(data), rows_per_chunk):
+            rows = slice(row_start, row_start + rows_per_chunk)
+            prediction = star_velocity(speed_star[walkers],
+                                       angular_speed[walkers],
+                                       phase[walkers], data[rows, 0])
+            chi_squared[walkers] += np.sum(
+                ((prediction - data[rows, 1]) / data[rows, 2])**2, axis=-1)
+
+    return np.where((parameters[:, 0] > 0) & (parameters[:, 1] > 0),
+                    -chi_squared / 2, -np.inf)
+
+
+def ensemble_sampler(data, start, number_of_steps=MCMC_STEPS,
+                     number_of_walkers=MCMC_WALKERS, thin=1, chain_file=None,
+                     checkpoint_file=None,
+                     checkpoint_steps=MCMC_CHECKPOINT_STEPS, seed=None):
+    """
+    Samples the posterior of [speed_star, angular_speed, phase] with an
+    affine invariant ensemble of walkers (Goodman & Weare stretch move). The
+    walkers are moved in two halves, each against the other, so every
+    half-step is a single vectorised log_posterior call. The phase is not
+    wrapped into [0, 2 pi).
+
+    Only every thin-th step is kept. With chain_file the kept steps are
+    streamed to a .npy file on disk rather than held in memory. With
+    checkpoint_file the walkers and random state are saved every
+    checkpoint_steps steps, and a run with the same files resumes from the
+    last checkpoint.
+
+    Parameters
+    ----------
+    data : numpy array
+    start : numpy array
+        [speed_star, angular_speed, phase], usually the best fit
+    number_of_steps : int
+        The default is MCMC_STEPS.
+    number_of_walkers : int
+        even, at least 6. The default is MCMC_WALKERS.
+    thin : int
+        The default is 1.
+    chain_file : string
+        The default is None.
+    checkpoint_file : string
+        .npz file. The default is None.
+    checkpoint_steps : int
+        The default is MCMC_CHECKPOINT_STEPS.
+    seed : int
+        The default is None.
+
+    Returns
+    -------
+    chain : numpy array
+        shape (number_of_steps // thin, number_of_walkers, 3)
+    acceptance_fraction : float
+
+    """
+    if number_of_walkers % 2 or number_of_walkers < 6:
+        raise ValueError('number_of_walkers must be even and at least 6')
+    start = np.asarray(start, dtype=float)
+    shape = (number_of_steps // thin, number_of_walkers, start.size)
+    half = number_of_walkers // 2
+
+    resume = checkpoint_file is not None and os.path.isfile(checkpoint_file)
+    if chain_file is None:
+        chain = np.empty(shape)
+    else:
+        chain = np.lib.format.open_memmap(
+            chain_file, mode='r+' if resume else 'w+', dtype=float,
+            shape=shape)
+
+    if resume:
+        with np.load(checkpoint_file, allow_pickle=False) as checkpoint:
+            walkers = checkpoint['walkers']
+            log_probability = checkpoint['log_probability']
+            first_step, accepted = (int(checkpoint['step']),
+                                    int(checkpoint['accepted']))
+            generator = np.random.default_rng()
+            generator.bit_generator.state = {
+                'bit_generator': str(checkpoint['bit_generator']),
+                'state': {'state': int(checkpoint['state']),
+                          'inc': int(checkpoint['inc'])},
+                'has_uint32': int(checkpoint['has_uint32']),
+                'uinteger': int(checkpoint['uinteger'])}
+            if chain_file is None:
+                chain[:first_step // thin] = checkpoint['chain']
+    else:
+        generator = np.random.default_rng(seed)
+        walkers = start * (1 + MCMC_START_SPREAD * generator.standard_normal(
+            (number_of_walkers, start.size)))
+        log_probability = log_posterior(walkers, data)
+        first_step, accepted = 0, 0
+
+    for step in range(first_step, number_of_steps):
+        for moving, fixed in ((slice(0, half), slice(half, None)),
+                              (slice(half, None), slice(0, half))):
+            stretch = ((MCMC_STRETCH - 1) * generator.random(half) + 1)**2 /\
+                MCMC_STRETCH
+            partners = walkers[fixed][generator.integers(0, half, half)]
+            proposal = partners + stretch[:, np.newaxis] * (
+                walkers[moving] - partners)
+            proposal_log_probability = log_posterior(proposal, data)
+            accept = np.log(generator.random(half)) < (
+                (start.size - 1) * np.log(stretch) +
+                proposal_log_probability - log_probability[moving])
+            walkers[moving][accept] = proposal[accept]
+            log_probability[moving][accept] = proposal_log_probability[accept]
+            accepted += np.count_nonzero(accept)
+
+        if (step + 1) % thin == 0 and (step + 1) // thin <= shape[0]:
+            chain[(step + 1) // thin - 1] = walkers
+
+        if checkpoint_file is not None and (
+                (step + 1) % checkpoint_steps == 0 or
+                step + 1 == number_of_steps):
+            if chain_file is not None:
+                chain.flush()
+            state = generator.bit_generator.state
+            temporary_file = checkpoint_file + '.tmp.npz'
+            np.savez(temporary_file, walkers=walkers,
+                     log_probability=log_probability, step=step + 1,
+                     accepted=accepted,
+                     bit_generator=state['bit_generator'],
+                     state=str(state['state']['state']),
+                     inc=str(state['state']['inc']),
+                     has_uint32=state['has_uint32'],
+                     uinteger=state['uinteger'],
+                     **({'chain': chain[:(step + 1) // thin]}
+                        if chain_file is None else {}))
+            os.replace(temporary_file, checkpoint_file)
+
+    if chain_file is not None:
+        chain.flush()
+
+    return chain, accepted / max(number_of_steps * number_of_walkers, 1)
+
+
+def planet_posterior(samples, mass_of_star=MASS_OF_STAR):
+    """
+    Passes posterior samples of [speed_star, angular_speed, phase] through
+    the planet calculators, giving samples of the planet's distance from the
+    star, velocity and mass.
+
+    Parameters
+    ----------
+    samples : numpy array
+        shape (..., 3), e.g. a chain from ensemble_sampler
+    mass_of_star : float
+        kilograms. The default is MASS_OF_STAR.
+
+    Returns
+    -------
+    planet_distance_from_star : numpy array
+        meters
+    velocity_of_planet : numpy array
+        meters / second
+    mass_of_planet : numpy array
+        kilograms
+
+    """
+    planet_distance_from_star = planet_distance_from_star_calculator(
+        samples[..., 1], mass_of_star)
+    velocity_of_planet = velocity_of_planet_calculator(
+        planet_distance_from_star, mass_of_star)
+    mass_of_planet = mass_of_planet_calculator(
+        samples[..., 0], velocity_of_planet, mass_of_star)
+
+    return planet_distance_from_star, velocity_of_planet, mass_of_planet
+
+
+def fit_covariance(fitted_parameters, data, phase):
+    """
+    Returns the covariance matrix of the speed of star and angular speed,
+    2 H^-1 where H is the Hessian of the chi squared at the minimum.
+
+    Parameters
+    ----------
+    fitted_parameters : numpy array
+    data : numpy array
+    phase : float
+        rad
+
+    Returns
+    -------
+    covariance : numpy array
+        2 x 2
+
+    """
+    return 2 * np.linalg.inv(chi_squared_derivatives(
+        fitted_parameters[0], fitted_parameters[1], data, phase)[2])
+
+
+def planet_uncertainties(fitted_parameters, covariance,
+                         mass_of_star=MASS_OF_STAR, number_of_samples=0,
+                         seed=None, percentiles=MONTE_CARLO_PERCENTILES):
+    """
+    Propagates the correlated uncertainty of the speed of star and angular
+    speed to the planet's distance from the star, velocity and mass.
+
+    With number_of_samples, correlated samples are drawn from the fit
+    covariance, all at once, and passed through the planet calculators by
+    planet_posterior; the percentiles of each quantity are reported. This
+    keeps the non-linear shape of the calculators. Without samples the
+    calculators are linearised at the fit, which is exact for small
+    uncertainties and much quicker; the median is then the fitted value and
+    the percentiles are those of the normal distribution.
+
+    Parameters
+    ----------
+    fitted_parameters : numpy array
+        [speed_star, angular_speed]
+    covariance : numpy array
+        2 x 2, e.g. from fit_covariance
+    mass_of_star : float
+        kilograms. The default is MASS_OF_STAR.
+    number_of_samples : int
+        The default is 0, the linearised path.
+    seed : int
+        The default is None.
+    percentiles : tuple of floats
+        lower, median and upper. The default is MONTE_CARLO_PERCENTILES.
 
-        data_file_3 = remove_outliers_1(np.vstack([read_data(DATA_FILE_1),
-                                                   read_data(DATA_FILE_2)]), 3)
-        data_file_3 = data_file_3[np.argsort(data_file_3[:, 0])]
-        time, wavelenght, wavelenght_uncertainty = (data_file_3[:, 0],
-                                                    data_file_3[:, 1],
-                                                    data_file_3[:, 2])
+    Returns
+    -------
+    uncertainties : dict
+        quantity in PROPAGATED_QUANTITIES: numpy array of its values at
+        percentiles
 
+    """
+    speed_star, angular_speed = fitted_parameters[0], fitted_parameters[1]
+
+    if number_of_samples:
+        generator = np.random.default_rng(seed)
+        samples = fitted_parameters[:2] + generator.standard_normal(
+            (number_of_samples, 2)) @ np.linalg.cholesky(covariance).T
+        quantities = (samples[:, 0], samples[:, 1]) + planet_posterior(
+            samples, mass_of_star)
+        return dict(zip(PROPAGATED_QUANTITIES,
+                        np.percentile(np.vstack(quantities), percentiles,
+                                      axis=1).T))
+
+    planet_distance_from_star, velocity_of_planet, mass_of_planet =\
+        planet_posterior(np.asarray(fitted_parameters), mass_of_star)
+    # d(quantity) / d(speed_star, angular_speed); r ~ w^-2/3, Vp ~ w^1/3 and
+    # Mp ~ v0 w^-1/3.
+    jacobian = np.array([
+        [1, 0],
+        [0, 1],
+        [0, -2 * planet_distance_from_star / (3 * angular_speed)],
+        [0, velocity_of_planet / (3 * angular_speed)],
+        [mass_of_planet / speed_star,
+         -mass_of_planet / (3 * angular_speed)]])
+    standard_deviations = np.sqrt(np.einsum('ij,jk,ik->i', jacobian,
+                                            covariance, jacobian))
+    normal_quantiles = np.array([NormalDist().inv_cdf(level / 100)
+                                 for level in percentiles])
+    values = (speed_star, angular_speed, planet_distance_from_star,
+              velocity_of_planet, mass_of_planet)
+
+    return {quantity: value + standard_deviation * normal_quantiles
+            for quantity, value, standard_deviation in
+            zip(PROPAGATED_QUANTITIES, values, standard_deviations)}
+
+
+def analyse_star(data_files, mass_of_star=MASS_OF_STAR,
+                 emitted_wavelenght=EMITTED_WAVELENGHT, plots=False,
+                 cache_directory=DATA_CACHE_DIRECTORY, number_of_samples=0,
+                 verbose=False, clip_iterations=OUTLIER_CLIP_ITERATIONS):
+    """
+    Reads and cleans the data of one star, fits the star velocity and finds
+    the planet's distance, velocity and mass, all with uncertainties. The
+    uncertainties never depend on the plots, which are only drawn when plots
+    is True. The planet uncertainties are propagated from the fit covariance
+    by planet_uncertainties, by sampling when number_of_samples is given.
+    Both outlier removals make clip_iterations passes. The default single
+    pass keeps the results of the original outlier removal;
+    SIGMA_CLIP_MAX_ITERATIONS clips until no more points are dropped.
+    Nothing is printed unless verbose is True, so it can run in workers.
+
+    Parameters
+    ----------
+    data_files : string or list of strings
+        file names or glob patterns
+    mass_of_star : float
+        kilograms. The default is MASS_OF_STAR.
+    emitted_wavelenght : float
+        meters. The default is EMITTED_WAVELENGHT.
+    plots : bool
+        The default is False.
+    cache_directory : string
+        The default is DATA_CACHE_DIRECTORY.
+    number_of_samples : int
+        The default is 0, the linearised path.
+    verbose : bool
+        The default is False.
+    clip_iterations : int
+        The default is OUTLIER_CLIP_ITERATIONS.
+
+    Returns
+    -------
+    results : dict
+        keyed by STAR_RESULT_COLUMNS, without name and status
+
+    """
+    from scipy.constants import au
+
+    combined_data = read_data_files(data_files, cache_directory)
+    profile_lap('read_data_files', number_of_points=len(combined_data))
+    keep = np.flatnonzero(sigma_clip_mask(combined_data[:, 1], 3,
+                                          max_iterations=clip_iterations))
+    data_file_3 = combined_data[keep[np.argsort(combined_data[keep, 0])]]
+    profile_lap('remove_outliers_1', number_of_points=len(data_file_3))
+    time, wavelenght, wavelenght_uncertainty = (data_file_3[:, 0],
+                                                data_file_3[:, 1],
+                                                data_file_3[:, 2])
+
+    if plots:
         plot_raw_data(data_file_3, 'Raw_data_plot.png')
-        # Convert to s from years and to m from nm
-        time *= YEARS_TO_SECONDS_CONVERSION
-        wavelenght *= NANOMETERS_TO_METERS_CONVERSION
-        wavelenght_uncertainty *= NANOMETERS_TO_METERS_CONVERSION
-        star_velocity_data = [time, star_velocity_calculator(wavelenght),
-                              uncertainty_propagation(star_velocity_calculator,
-                                                      wavelenght, 0,
-                                                      wavelenght_uncertainty)]
-        star_velocity_data_numpy_array = np.array(star_velocity_data).T
-        # create an initial fit and remove data points that are far away from
-        # the best fit.
-        initial_fit = minimisation(star_velocity_data, 3)
-        speed_star, angular_speed, phase = (initial_fit[0][0],
-                                            initial_fit[0][1],
-                                            initial_fit[0][2])
-        cleaned_star_velocity_data = remove_outliers_2(
-            star_velocity_data_numpy_array, 1, speed_star,
-            angular_speed, phase)
-        cleaned_star_velocity_data_list = [cleaned_star_velocity_data[:, 0],
-                                           cleaned_star_velocity_data[:, 1],
-                                           cleaned_star_velocity_data[:, 2]]
-        # find the phase
-        fit_1 = minimisation(cleaned_star_velocity_data_list, 3)
-        phase = fit_1[0][2]
-        # Find speed of star and angular speed using the found value
-        # of phase
-        fit_2 = minimisation(cleaned_star_velocity_data_list, 2, phase)
-        fitted_parameters = fit_2[0]
-        minimum_chi_squared = fit_2[1]
-        reduced_chi_squared = minimum_chi_squared /\
-            (len(cleaned_star_velocity_data) - 2)
-        speed_star = fit_2[0][0]
-        angular_speed = fit_2[0][1]
-        # Plot fitted data and contour plot
+    # Convert to s from years and to m from nm
+    time *= YEARS_TO_SECONDS_CONVERSION
+    wavelenght *= NANOMETERS_TO_METERS_CONVERSION
+    wavelenght_uncertainty *= NANOMETERS_TO_METERS_CONVERSION
+    star_velocity_data = [time,
+                          star_velocity_calculator(wavelenght,
+                                                   emitted_wavelenght),
+                          star_velocity_uncertainty_calculator(
+                              wavelenght_uncertainty, emitted_wavelenght)]
+    star_velocity_data_numpy_array = np.column_stack(star_velocity_data)
+    profile_lap('star_velocity_calculator', number_of_points=len(time))
+    # create an initial fit and remove data points that are far away from
+    # the best fit.
+    if len(time) <= PERIODOGRAM_MAX_DATA_POINTS:
+        initial_fit = periodogram_fit(star_velocity_data)
+        profile_lap('periodogram_fit', number_of_points=len(time))
+    else:
+        initial_fit = separable_fit(star_velocity_data)
+        profile_lap('separable_fit', number_of_points=len(time))
+    speed_star, angular_speed, phase = (initial_fit[0][0],
+                                        initial_fit[0][1],
+                                        initial_fit[0][2])
+    keep = model_residual_mask(
+        star_velocity_data_numpy_array, 1, speed_star, angular_speed,
+        phase, scale=np.std(star_velocity_data[1], ddof=1),
+        max_iterations=clip_iterations)
+    if verbose and keep.all():
+        print('No data was removed')
+    cleaned_star_velocity_data = star_velocity_data_numpy_array[keep]
+    cleaned_star_velocity_data_list = [cleaned_star_velocity_data[:, 0],
+                                       cleaned_star_velocity_data[:, 1],
+                                       cleaned_star_velocity_data[:, 2]]
+    profile_lap('remove_outliers_2',
+                number_of_points=len(cleaned_star_velocity_data))
+    # Fit the cleaned data. The phase, speed of star and angular speed
+    # all come from one fit.
+    fit = separable_fit(cleaned_star_velocity_data_list, angular_speed)
+    profile_lap('separable_fit',
+                number_of_points=len(cleaned_star_velocity_data))
+    phase = fit[0][2]
+    fitted_parameters = fit[0][:2]
+    minimum_chi_squared = fit[1]
+    reduced_chi_squared = minimum_chi_squared /\
+        (len(cleaned_star_velocity_data) - 2)
+    speed_star = fit[0][0]
+    angular_speed = fit[0][1]
+    if plots:
         plot_fitted_data('plot_of_velocity_against_time_without_outliers.png',
                          fitted_parameters, minimum_chi_squared,
                          cleaned_star_velocity_data,
                          phase)
-        parameters_contour_plot = contour_plot_function(
-            fitted_parameters,
-            cleaned_star_velocity_data,
-            minimum_chi_squared,
-            phase)[1]
-        # Uncertaintys on speed of star and angular speed
-        speed_star_uncertainty, angular_speed_uncertainty\
-            = uncertainty_from_contour_plot(parameters_contour_plot)
-        # Calculation of other physical values
-        planet_distance_from_star = planet_distance_from_star_calculator(
-            angular_speed)
-        planet_distance_from_star_au = planet_distance_from_star /\
-            METERS_TO_AU_CONVERSION
-        velocity_of_planet = velocity_of_planet_calculator(
-            planet_distance_from_star)
-        mass_of_planet = mass_of_planet_calculator(
-            speed_star, velocity_of_planet)
-        mass_of_planet_jovian_mass = mass_of_planet /\
-            KILOGRAMS_TO_JOVIAN_MASS_CONVERSION
-        # Now find uncertainty on these values
-        planet_distance_from_star_uncertainty = uncertainty_propagation(
-            planet_distance_from_star_calculator,
-            angular_speed,
-            0,
-            angular_speed_uncertainty)
-        planet_distance_from_star_uncertainty_au =\
-            planet_distance_from_star_uncertainty / METERS_TO_AU_CONVERSION
-        velocity_of_planet_uncertainty =\
-            uncertainty_propagation(velocity_of_planet_calculator,
-                                    planet_distance_from_star,
-                                    0,
-                                    planet_distance_from_star_uncertainty)
-        mass_of_planet_uncertainty =\
-            uncertainty_propagation(mass_of_planet_calculator,
-                                    speed_star,
-                                    velocity_of_planet,
-                                    speed_star_uncertainty)
-        mass_of_planet_uncertainty_jovian_mass = mass_of_planet_uncertainty /\
-            (KILOGRAMS_TO_JOVIAN_MASS_CONVERSION)
+        contour_plot_function(fitted_parameters, cleaned_star_velocity_data,
+                              minimum_chi_squared, phase)
+    # Uncertaintys on speed of star and angular speed
+    speed_star_uncertainty, angular_speed_uncertainty = profile_uncertainty(
+        fitted_parameters, cleaned_star_velocity_data, phase,
+        minimum_chi_squared)
+    profile_lap('profile_uncertainty',
+                number_of_points=len(cleaned_star_velocity_data))
+    # Calculation of other physical values
+    planet_distance_from_star = planet_distance_from_star_calculator(
+        angular_speed, mass_of_star)
+    velocity_of_planet = velocity_of_planet_calculator(
+        planet_distance_from_star, mass_of_star)
+    mass_of_planet = mass_of_planet_calculator(
+        speed_star, velocity_of_planet, mass_of_star)
+    profile_lap('planet_calculators')
+    # Now find uncertainty on these values, half of the one standard
+    # deviation interval, with the correlation of v0 and w kept.
+    intervals = planet_uncertainties(
+        fitted_parameters, fit_covariance(fitted_parameters,
+                                          cleaned_star_velocity_data, phase),
+        mass_of_star, number_of_samples)
+    (planet_distance_from_star_uncertainty, velocity_of_planet_uncertainty,
+     mass_of_planet_uncertainty) = ((intervals[quantity][2] -
+                                     intervals[quantity][0]) / 2 for
+                                    quantity in PROPAGATED_QUANTITIES[2:])
+    profile_lap('planet_uncertainties', number_of_samples=number_of_samples)
+
+    return {'number_of_points': len(cleaned_star_velocity_data),
+            'speed_star': speed_star,
+            'speed_star_uncertainty': speed_star_uncertainty,
+            'angular_speed': angular_speed,
+            'angular_speed_uncertainty': angular_speed_uncertainty,
+            'phase': phase,
+            'planet_distance_from_star_au':
+                planet_distance_from_star / au,
+            'planet_distance_from_star_uncertainty_au':
+                planet_distance_from_star_uncertainty / au,
+            'velocity_of_planet': velocity_of_planet,
+            'velocity_of_planet_uncertainty': velocity_of_planet_uncertainty,
+            'mass_of_planet_jovian_mass':
+                mass_of_planet / KILOGRAMS_TO_JOVIAN_MASS_CONVERSION,
+            'mass_of_planet_uncertainty_jovian_mass':
+                mass_of_planet_uncertainty /
+                KILOGRAMS_TO_JOVIAN_MASS_CONVERSION,
+            'reduced_chi_squared': reduced_chi_squared}
+
+
+def read_manifest(filename):
+    """
+    Reads a manifest of stars. Each row has a name, the star's data files
+    separated by ';' (glob patterns allowed), its mass_of_star in kg and its
+    emitted_wavelenght in m.
+
+    Parameters
+    ----------
+    filename : string
+
+    Returns
+    -------
+    stars : list of dicts
+
+    """
+    with open(filename, 'r', newline='') as file:
+        return [{'name': row['name'],
+                 'data_files': [pattern.strip() for pattern in
+                                row['data_files'].split(';')],
+                 'mass_of_star': float(row['mass_of_star']),
+                 'emitted_wavelenght': float(row['emitted_wavelenght'])}
+                for row in csv.DictReader(file)]
+
+
+def analyse_manifest_star(star, profile=False):
+    """
+    Runs analyse_star for one star of a manifest without plots. A star that
+    cannot be analysed, whatever the error, gets its error message as its
+    status instead of stopping the batch. With profile the star is profiled
+    in its own worker process and the report is returned under 'profile'.
+
+    Parameters
+    ----------
+    star : dict
+        a row from read_manifest
+    profile : bool
+        The default is False.
+
+    Returns
+    -------
+    results : dict
+        keyed by STAR_RESULT_COLUMNS, and 'profile' when profile is True
+
+    """
+    with profiling(None, profile) as report:
+        try:
+            results = analyse_star(star['data_files'], star['mass_of_star'],
+                                   star['emitted_wavelenght'])
+            results['status'] = 'ok'
+        except Exception as error:
+            results = {'status': '{0:s}: {1}'.format(type(error).__name__,
+                                                     error)}
+    results['name'] = star['name']
+    if profile:
+        results['profile'] = report
+
+    return results
+
+
+def run_batch(manifest, output_file=BATCH_RESULTS_FILE, workers=None,
+              report_file=None):
+    """
+    Analyses every star in a manifest in a pool of worker processes, with no
+    plots, and writes one row of results per star to output_file. With
+    report_file the batch is profiled as by profile_stop, with the report of
+    each star, profiled in its worker, under 'stars'.
+
+    Parameters
+    ----------
+    manifest : string
+        file name of the manifest
+    output_file : string
+        The default is BATCH_RESULTS_FILE.
+    workers : int
+        number of processes. The default is None, which uses every core.
+    report_file : string
+        The default is None, no profiling.
+
+    Returns
+    -------
+    results : list of dicts
+
+    """
+    profile = report_file is not None
+    with profiling(report_file, profile):
+        stars = read_manifest(manifest)
+        profile_lap('read_manifest', number_of_stars=len(stars))
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(analyse_manifest_star, stars,
+                                        [profile] * len(stars)))
+        profile_lap('analyse_manifest_star', number_of_stars=len(stars))
+        for star_results in results:
+            if star_results['status'] != 'ok':
+                print("'{0:s}' was not analysed. {1:s}".format(
+                    star_results['name'], star_results['status']))
+            if profile:
+                profile_star(star_results['name'],
+                             star_results.pop('profile'))
+
+        with open(output_file, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=STAR_RESULT_COLUMNS,
+                                    restval='')
+            writer.writeheader()
+            writer.writerows(results)
+        profile_lap('write_results', number_of_stars=len(stars))
+
+    return results
+
+
+def main(arguments=None):
+    """
+    Main code for program.
+    """
+    parser = argparse.ArgumentParser(description='Doppler spectroscopy.')
+    parser.add_argument('--batch', metavar='MANIFEST',
+                        help='analyse every star in a manifest CSV')
+    parser.add_argument('--output', default=BATCH_RESULTS_FILE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--samples', nargs='?', type=int,
+                        const=MONTE_CARLO_SAMPLES, default=0, metavar='N',
+                        help=('propagate the planet uncertainties with N '
+                              'samples of the fit covariance'))
+    parser.add_argument('--clip-iterations', nargs='?', type=int,
+                        const=SIGMA_CLIP_MAX_ITERATIONS,
+                        default=OUTLIER_CLIP_ITERATIONS, metavar='N',
+                        help=('remove outliers in up to N passes instead of '
+                              'one, until no more points are dropped'))
+    parser.add_argument('--profile', nargs='?', const=PROFILE_REPORT_FILE,
+                        default=os.environ.get(PROFILE_ENVIRONMENT_VARIABLE)
+                        or None, metavar='REPORT',
+                        help=('write the time, memory and chi squared '
+                              'evaluations of each stage to REPORT as JSON '
+                              "('-' for the standard output)"))
+    arguments = parser.parse_args(arguments)
+
+    if arguments.batch is not None:
+        run_batch(arguments.batch, arguments.output, arguments.workers,
+                  arguments.profile)
+        return 0
+
+    # Read in data
+    if file_check(DATA_FILE_1) and file_check(DATA_FILE_2):
+
+        with profiling(arguments.profile, arguments.profile is not None):
+            results = analyse_star([DATA_FILE_1, DATA_FILE_2], plots=True,
+                                   number_of_samples=arguments.samples,
+                                   verbose=True,
+                                   clip_iterations=arguments.clip_iterations)
         print('The reduced chi squared value is: {0:.3g}'.
-              format(reduced_chi_squared))
+              format(results['reduced_chi_squared']))
         print(r'The phase is: {0:.4g} rad '.
-              format(phase))
+              format(results['phase']))
         print(('The magnitude of the star velocity (V0) is: '
                '({0:.4g} +/- {1:.2f}) m/s').
-              format(speed_star,
-                     speed_star_uncertainty))
+              format(results['speed_star'],
+                     results['speed_star_uncertainty']))
         print(('The angular speed is (w): '
                '({0:.4g} +/- {1:.2g}) rad/s').
-              format(angular_speed, angular_speed_uncertainty))
+              format(results['angular_speed'],
+                     results['angular_speed_uncertainty']))
         print(('The planets distance from the star (r) is: '
                '({0:.4g} +/- {1:.3g}) AU').
-              format(planet_distance_from_star_au,
-                     planet_distance_from_star_uncertainty_au))
+              format(results['planet_distance_from_star_au'],
+                     results['planet_distance_from_star_uncertainty_au']))
         print(('The velocity of the planet (Vp) is: '
                '({0:.4g} +/- {1:.4g}) m/s').
-              format(velocity_of_planet,
-                     velocity_of_planet_uncertainty))
+              format(results['velocity_of_planet'],
+                     results['velocity_of_planet_uncertainty']))
         print(('The mass of the planet (Mp) is: '
                '({0:.4g} +/- {1:.3g}) Jovian masses').format
-              (mass_of_planet_jovian_mass,
-               mass_of_planet_uncertainty_jovian_mass))
+              (results['mass_of_planet_jovian_mass'],
+               results['mass_of_planet_uncertainty_jovian_mass']))
     return 0
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+________________TITLE__________________________
+PHYS20161 - Assignment 2 - Doppler Spectroscopy benchmarks
+-----------------------------------------------
+This python script writes synthetic data files in the same format as the
+doppler data files (time in years, wavelenght in nm and its uncertainty, with
+failed rows and outliers) and times each stage of the doppler spectroscopy
+analysis on them for sizes from 10^2 to 10^7 points. The wall time and peak
+memory of every stage are saved to a JSON file, which can be compared with an
+earlier baseline to catch regressions.
+
+Usage: python doppler_spectroscopy_benchmark.py [--sizes 100 1000 ...]
+       [--output doppler_benchmark.json] [--baseline old.json]
+"""
+# IMPORT STATEMENTS
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import doppler_spectroscopy_assignment as doppler
+
+# CONSTANTS
+
+BENCHMARK_SIZES = (10**2, 10**3, 10**4, 10**5, 10**6, 10**7)
+BENCHMARK_FILE = 'doppler_benchmark.json'
+BENCHMARK_SEED = 20161
+BENCHMARK_GRID_POINTS = 100  # per side of the chi_squared_for_plot grid
+REGRESSION_TOLERANCE = 1.5  # slower than baseline by this factor is flagged
+REGRESSION_MINIMUM_SECONDS = 0.01  # quicker stages are too noisy to compare
+SYNTHETIC_SPEED_STAR = 52  # m/s
+SYNTHETIC_ANGULAR_SPEED = 3.1 * 10**-8  # rad/s
+SYNTHETIC_PHASE = 3  # rad
+SYNTHETIC_VELOCITY_UNCERTAINTY = 4  # m/s
+SYNTHETIC_FAILED_FRACTION = 0.01
+SYNTHETIC_OUTLIER_FRACTION = 0.005
+SYNTHETIC_CHUNK_ROWS = 10**5
+SYNTHETIC_YEARS = 6
+# The periodogram, fmin and grid stages cost hundreds or thousands of passes
+# over the data, so they are skipped above these sizes. analyse_star skips
+# the periodogram above the same size.
+STAGE_MAX_POINTS = {'periodogram_fit': doppler.PERIODOGRAM_MAX_DATA_POINTS,
+                    'minimisation': 10**6,
+                    'chi_squared_for_plot': 10**6,
+                    'contour_plot_function': 10**6}
+
+
+def synthetic_doppler_data(filename, number_of_points, seed=BENCHMARK_SEED,
+                           speed_star=SYNTHETIC_SPEED_STAR,
+                           angular_speed=SYNTHETIC_ANGULAR_SPEED,
+                           phase=SYNTHETIC_PHASE,
+                           failed_fraction=SYNTHETIC_FAILED_FRACTION,
+                           outlier_fraction=SYNTHETIC_OUTLIER_FRACTION):
+    """
+    Writes a synthetic data file in the doppler data format. The star velocity
+    is speed_star sin(angular_speed t + phase) with gaussian noise, and is
+    turned into an observed wavelenght of the H-alpha line. A fraction of the
+    rows have 'fail' as their wavelenght and a fraction are shifted far from
+    the curve. The file is written in chunks so it never has to fit in
+    memory as text.
+
+    Parameters
+    ----------
+    filename : string
+    number_of_points : int
+    seed : int
+        The default is BENCHMARK_SEED.
+    speed_star : float
+        meters / second. The default is SYNTHETIC_SPEED_STAR.
+    angular_speed : float
+        rad / second. The default is SYNTHETIC_ANGULAR_SPEED.
+    phase : float
+        rad. The default is SYNTHETIC_PHASE.
+    failed_fraction : float
+        The default is SYNTHETIC_FAILED_FRACTION.
+    outlier_fraction : float
+        The default is SYNTHETIC_OUTLIER_FRACTION.
+
+    Returns
+    -------
+    None.
+
+    """
+    from scipy.constants import speed_of_light
+
+    generator = np.random.default_rng(seed)
+    nanometers_per_velocity = doppler.EMITTED_WAVELENGHT / (
+        speed_of_light * doppler.NANOMETERS_TO_METERS_CONVERSION)
+    step = SYNTHETIC_YEARS / number_of_points
+
+    with open(filename, 'w', newline='') as file:
+        file.write('% Time (years),Wavelength (nm),Uncertainty (nm)\n')
+        for first in range(0, number_of_points, SYNTHETIC_CHUNK_ROWS):
+            rows = min(SYNTHETIC_CHUNK_ROWS, number_of_points - first)
+            years = (first + np.arange(rows) +
+                     generator.random(rows)) * step
+            uncertainty = SYNTHETIC_VELOCITY_UNCERTAINTY * generator.uniform(
+                0.5, 1.5, rows)
+            velocity = speed_star * np.sin(
+                angular_speed * years * doppler.YEARS_TO_SECONDS_CONVERSION +
+                phase) + uncertainty * generator.standard_normal(rows)
+            outliers = generator.random(rows) < outlier_fraction
+            velocity[outliers] += 20 * speed_star * np.sign(
+                generator.standard_normal(np.count_nonzero(outliers)))
+
+            text = io.StringIO()
+            np.savetxt(text, np.column_stack((
+                years,
+                (velocity + speed_of_light) *
+                nanometers_per_velocity,
+                uncertainty * nanometers_per_velocity)),
+                       fmt=('%.8f', '%.10f', '%.6e'), delimiter=',')
+            lines = text.getvalue().splitlines()
+            for row in np.flatnonzero(generator.random(rows) <
+                                      failed_fraction):
+                time_entry, _, uncertainty_entry = lines[row].split(',')
+                lines[row] = ','.join((time_entry, 'fail',
+                                       uncertainty_entry))
+            file.write('\n'.join(lines) + '\n')
+
+
+def time_stage(function, *arguments):
+    """
+    Runs function once, measuring its wall time and peak memory allocation.
+
+    Parameters
+    ----------
+    function : function
+    *arguments
+
+    Returns
+    -------
+    result
+        whatever function returns
+    seconds : float
+    peak_bytes : int
+
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*arguments)
+    seconds = time.perf_counter() - start
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, seconds, peak_bytes
+
+
+def benchmark_size(number_of_points, directory, seed=BENCHMARK_SEED,
+                   grid_points=BENCHMARK_GRID_POINTS):
+    """
+    Times each stage of the doppler analysis on one synthetic data file,
+    passing the output of each stage on to the next as main does.
+
+    Parameters
+    ----------
+    number_of_points : int
+    directory : string
+        where the data file, cache and plots are written
+    seed : int
+        The default is BENCHMARK_SEED.
+    grid_points : int
+        The default is BENCHMARK_GRID_POINTS.
+
+    Returns
+    -------
+    results : list of dicts
+
+    """
+    filename = os.path.join(directory, 'synthetic_{0:d}.csv'.format(
+        number_of_points))
+    cache_directory = os.path.join(directory, 'cache')
+    start = time.perf_counter()
+    synthetic_doppler_data(filename, number_of_points, seed)
+    results = [{'size': number_of_points, 'stage': 'synthetic_doppler_data',
+                'seconds': time.perf_counter() - start, 'peak_bytes': None}]
+
+    def record(stage, function, *arguments):
+        if number_of_points > STAGE_MAX_POINTS.get(stage, number_of_points):
+            results.append({'size': number_of_points, 'stage': stage,
+                            'seconds': None, 'peak_bytes': None,
+                            'skipped': True})
+            return None
+        result, seconds, peak_bytes = time_stage(function, *arguments)
+        results.append({'size': number_of_points, 'stage': stage,
+                        'seconds': seconds, 'peak_bytes': peak_bytes})
+        return result
+
+    data = record('read_data', doppler.read_data, filename)
+    record('read_data_cached (build)', doppler.read_data_cached, filename,
+           cache_directory)
+    record('read_data_cached', doppler.read_data_cached, filename,
+           cache_directory)
+    data = record('remove_outliers_1', doppler.remove_outliers_1, data, 3)
+    data = data[np.argsort(data[:, 0])]
+
+    data[:, 0] *= doppler.YEARS_TO_SECONDS_CONVERSION
+    data[:, 1:] *= doppler.NANOMETERS_TO_METERS_CONVERSION
+    velocity_data = np.column_stack((
+        data[:, 0], doppler.star_velocity_calculator(data[:, 1]),
+        doppler.star_velocity_uncertainty_calculator(data[:, 2])))
+    velocity_list = [velocity_data[:, 0], velocity_data[:, 1],
+                     velocity_data[:, 2]]
+
+    fit = record('periodogram_fit', doppler.periodogram_fit, velocity_list)
+    if fit is None:
+        fit = doppler.separable_fit(velocity_list)
+    velocity_data = record('remove_outliers_2', doppler.remove_outliers_2,
+                           velocity_data, 1, *fit[0])
+    velocity_list = [velocity_data[:, 0], velocity_data[:, 1],
+                     velocity_data[:, 2]]
+    fit = record('separable_fit', doppler.separable_fit, velocity_list,
+                 fit[0][1])
+    record('minimisation', doppler.minimisation, velocity_list, 3)
+    fitted_parameters, phase, minimum_chi_squared = (fit[0][:2], fit[0][2],
+                                                     fit[1])
+
+    x_mesh, y_mesh = doppler.mesh_arrays(
+        np.linspace(-1, 1, grid_points) * doppler.X_VALUES_SHIFT_CONTOUR_PLOT +
+        fitted_parameters[0],
+        np.linspace(-1, 1, grid_points) * doppler.Y_VALUES_SHIFT_CONTOUR_PLOT +
+        fitted_parameters[1])
+    record('chi_squared_for_plot', doppler.chi_squared_for_plot, x_mesh,
+           y_mesh, velocity_data, phase)
+    record('profile_uncertainty', doppler.profile_uncertainty,
+           fitted_parameters, velocity_data, phase, minimum_chi_squared)
+    covariance = record('fit_covariance', doppler.fit_covariance,
+                        fitted_parameters, velocity_data, phase)
+    record('planet_uncertainties', doppler.planet_uncertainties,
+           fitted_parameters, covariance, doppler.MASS_OF_STAR,
+           doppler.MONTE_CARLO_SAMPLES)
+
+    working_directory = os.getcwd()
+    os.chdir(directory)
+    try:
+        record('contour_plot_function', doppler.contour_plot_function,
+               fitted_parameters, velocity_data, minimum_chi_squared, phase)
+    finally:
+        doppler.pyplot().close('all')
+        os.chdir(working_directory)
+
+    return results
+
+
+def compare_to_baseline(results, baseline,
+                        tolerance=REGRESSION_TOLERANCE):
+    """
+    Finds the stages that are more than tolerance times slower than in a
+    baseline. Stages that took under REGRESSION_MINIMUM_SECONDS in the
+    baseline are ignored as timer noise.
+
+    Parameters
+    ----------
+    results : list of dicts
+    baseline : list of dicts
+    tolerance : float
+        The default is REGRESSION_TOLERANCE.
+
+    Returns
+    -------
+    regressions : list of dicts
+        size, stage, seconds, baseline_seconds
+
+    """
+    baseline_seconds = {(entry['size'], entry['stage']): entry['seconds']
+                        for entry in baseline}
+    regressions = []
+    for entry in results:
+        before = baseline_seconds.get((entry['size'], entry['stage']))
+        if before is None or before < REGRESSION_MINIMUM_SECONDS:
+            continue
+        if entry['seconds'] and entry['seconds'] > tolerance * before:
+            regressions.append({'size': entry['size'],
+                                'stage': entry['stage'],
+                                'seconds': entry['seconds'],
+                                'baseline_seconds': before})
+
+    return regressions
+
+
+def run_benchmark(sizes=BENCHMARK_SIZES, output_file=BENCHMARK_FILE,
+                  seed=BENCHMARK_SEED, grid_points=BENCHMARK_GRID_POINTS):
+    """
+    Benchmarks every size and saves the results with a description of the
+    machine to output_file as JSON.
+
+    Parameters
+    ----------
+    sizes : tuple of ints
+        The default is BENCHMARK_SIZES.
+    output_file : string
+        The default is BENCHMARK_FILE.
+    seed : int
+        The default is BENCHMARK_SEED.
+    grid_points : int
+        The default is BENCHMARK_GRID_POINTS.
+
+    Returns
+    -------
+    report : dict
+
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for number_of_points in sizes:
+            for entry in benchmark_size(number_of_points, directory, seed,
+                                        grid_points):
+                results.append(entry)
+                if entry['seconds'] is not None:
+                    print('{0:>10d} {1:<28s} {2:10.4f} s'.format(
+                        entry['size'], entry['stage'], entry['seconds']))
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': sys.version.split()[0],
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'processor': platform.processor(),
+              'seed': seed,
+              'grid_points': grid_points,
+              'results': results}
+    with open(output_file, 'w') as file:
+        json.dump(report, file, indent=1)
+
+    return report
+
+
+def main(arguments=None):
+    """
+    Main code for program.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the doppler spectroscopy analysis.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(BENCHMARK_SIZES))
+    parser.add_argument('--output', default=BENCHMARK_FILE)
+    parser.add_argument('--seed', type=int, default=BENCHMARK_SEED)
+    parser.add_argument('--grid-points', type=int,
+                        default=BENCHMARK_GRID_POINTS)
+    parser.add_argument('--baseline', default=None,
+                        help='earlier JSON report to compare against')
+    arguments = parser.parse_args(arguments)
+
+    report = run_benchmark(arguments.sizes, arguments.output, arguments.seed,
+                           arguments.grid_points)
+
+    if arguments.baseline is not None:
+        with open(arguments.baseline, 'r') as file:
+            regressions = compare_to_baseline(report['results'],
+                                              json.load(file)['results'])
+        for regression in regressions:
+            print('Regression: {0:s} at {1:d} points took {2:.4f} s, '
+                  'baseline {3:.4f} s'.format(regression['stage'],
+                                              regression['size'],
+                                              regression['seconds'],
+                                              regression['baseline_seconds']))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+The assignment scripts sit in the top folder of the repository, so it is put
+on the path for the tests to import them.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that bounce_engine gives the same total time, total distance and
+number of bounces as the loops in total_time, total_distance and
+total_bounces.
+"""
+import itertools
+import numpy as np
+import pytest
+import bouncy_ball_1st_assignment as bouncy_ball
+
+# initial heights and minimum heights that land exactly on a bounce height,
+# e.g. 1 * 0.5**2 = 0.25, test the boundary where the logarithm can be off
+# by one.
+INITIAL_HEIGHTS = (0.3, 1, 2.5, 10, 123.4)
+MINIMUM_HEIGHTS = (0.01, 0.25, 0.5, 1, 5)
+EFFICIENCIES = (0.05, 0.1, 0.5, 0.7, 0.9, 0.99, 0.999)
+SCENARIOS = [scenario for scenario in
+             itertools.product(INITIAL_HEIGHTS, MINIMUM_HEIGHTS,
+                               EFFICIENCIES) if scenario[0] >= scenario[1]]
+
+
+@pytest.mark.parametrize('initial_height, minimum_height, efficiency',
+                         SCENARIOS)
+def test_bounce_engine_matches_loops(initial_height, minimum_height,
+                                     efficiency):
+    time, distance, bounces = bouncy_ball.bounce_engine(
+        initial_height, minimum_height, efficiency)
+
+    assert bounces == bouncy_ball.total_bounces(initial_height,
+                                                minimum_height, efficiency)
+    assert time == pytest.approx(bouncy_ball.total_time(
+        initial_height, minimum_height, efficiency), rel=1e-9)
+    assert distance == pytest.approx(bouncy_ball.total_distance(
+        initial_height, minimum_height, efficiency), rel=1e-9)
+
+
+def test_bounce_engine_arrays_match_loops():
+    initial_height, minimum_height, efficiency = (np.array(column) for
+                                                  column in zip(*SCENARIOS))
+
+    time, distance, bounces = bouncy_ball.bounce_engine(
+        initial_height, minimum_height, efficiency)
+
+    np.testing.assert_array_equal(bounces, [bouncy_ball.total_bounces(
+        *scenario) for scenario in SCENARIOS])
+    np.testing.assert_allclose(time, [bouncy_ball.total_time(*scenario)
+                                      for scenario in SCENARIOS], rtol=1e-9)
+    np.testing.assert_allclose(distance, [bouncy_ball.total_distance(
+        *scenario) for scenario in SCENARIOS], rtol=1e-9)
+
+
+def test_bounce_engine_invalid_scenarios_are_nan():
+    time, distance, bounces = bouncy_ball.bounce_engine(
+        [1, 1, 1], [2, 0.1, 0.1], [0.5, 0, 1.5])
+
+    assert np.isnan(time).all()
+    assert np.isnan(distance).all()
+    assert np.isnan(bounces).all()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the vectorised chi squared evaluations and the separable fit of the
+doppler spectroscopy analysis against the straightforward calculations they
+replaced.
+"""
+import numpy as np
+import pytest
+import doppler_spectroscopy_assignment as doppler
+
+NUMBER_OF_POINTS = 300
+SPEED_STAR = 52  # m/s
+ANGULAR_SPEED = 3.1 * 10**-8  # rad/s
+PHASE = 3  # rad
+
+
+@pytest.fixture
+def data():
+    """
+    Synthetic rows of [time, star velocity, uncertainty] like the cleaned
+    assignment data.
+    """
+    generator = np.random.default_rng(20161)
+    time = np.sort(generator.uniform(0, 6 * 3.154 * 10**7, NUMBER_OF_POINTS))
+    uncertainty = generator.uniform(3, 7, NUMBER_OF_POINTS)
+    velocity = (doppler.star_velocity(SPEED_STAR, ANGULAR_SPEED, PHASE, time)
+                + uncertainty * generator.standard_normal(NUMBER_OF_POINTS))
+    return np.column_stack((time, velocity, uncertainty))
+
+
+@pytest.mark.parametrize('chunk_elements',
+                         [doppler.CHI_SQUARED_CHUNK_ELEMENTS, 7])
+def test_chi_squared_surface_matches_loop(data, chunk_elements):
+    speed_star, angular_speed = np.meshgrid(
+        np.linspace(48, 56, 9), np.linspace(3.0, 3.2, 7) * 10**-8)
+
+    surface = doppler.chi_squared_surface(speed_star, angular_speed, data,
+                                          PHASE, chunk_elements)
+
+    expected = np.empty(speed_star.shape)
+    for i in range(speed_star.shape[0]):
+        for j in range(speed_star.shape[1]):
+            expected[i, j] = doppler.chi_squared_calculator(
+                doppler.star_velocity(speed_star[i, j], angular_speed[i, j],
+                                      PHASE, data[:, 0]),
+                data[:, 1], data[:, 2])
+    np.testing.assert_allclose(surface, expected, rtol=1e-9)
+
+
+def test_separable_fit_matches_minimisation(data):
+    data_list = [data[:, 0], data[:, 1], data[:, 2]]
+
+    separable = doppler.separable_fit(data_list)
+    simplex = doppler.minimisation(data_list, 3)
+
+    assert separable[1] <= simplex[1] * (1 + 10**-9)
+    assert separable[1] == pytest.approx(simplex[1], rel=10**-6)
+    np.testing.assert_allclose(separable[0], simplex[0], rtol=10**-4)
+
+
+def test_log_posterior_chunks_match_one_evaluation(data):
+    generator = np.random.default_rng(0)
+    parameters = np.column_stack((
+        generator.normal(SPEED_STAR, 1, 16),
+        generator.normal(ANGULAR_SPEED, 10**-10, 16),
+        generator.normal(PHASE, 0.01, 16)))
+    parameters[3, 0] = -1
+
+    chunked = doppler.log_posterior(parameters, data, chunk_elements=64)
+    whole = doppler.log_posterior(parameters, data,
+                                  chunk_elements=parameters.size * len(data))
+
+    assert chunked[3] == -np.inf
+    np.testing.assert_allclose(chunked, whole, rtol=1e-12)